@@ -2,34 +2,29 @@ import numpy as np
 import pandas as pd
 import os
 import sys
-import psycopg2
 from bokeh.io import curdoc
 from bokeh.layouts import row, column
 from bokeh.models import ColumnDataSource, DataRange1d, Select
 from bokeh.models import BoxAnnotation
 from bokeh.palettes import Blues4
 from bokeh.plotting import figure
-import pickle
 
 home_path = os.environ['CASCADE_HOME']
 
 sys.path.append(home_path + 'cascade/src')
 from cascade_model import prepare_xy, make_xy
-from cascade_plot import fetch_data_for_plotting, web_prop_list
+from cascade_registry import predict_proba
+from cascade_plot import fetch_data_for_plotting, web_prop_list, build_prediction_store
 
-dbname = os.environ['CASCADE_DB_DBNAME']
-host = os.environ['CASCADE_DB_HOST']
-username = os.environ['CASCADE_DB_USERNAME']
-password = os.environ['CASCADE_DB_PASSWORD']
-port = 5432
-
-def get_dataset(X, prop, gbc_predict):
-    start_date = str(X.day.loc[X_test.index].iloc[0])
+def get_dataset(X, prop, prediction_store):
+    start_date = str(X.day.iloc[0])
     y_series, predicted, num_years = fetch_data_for_plotting(X,
                                                              prop,
-                                                             gbc_predict,
+                                                             None,
                                                              start_date,
-                                                             True)
+                                                             True,
+                                                             baseline=baseline,
+                                                             store=prediction_store)
 
     joined = pd.merge(y_series, predicted, left_index=True, right_index=True)
     joined.columns = ['occupied', 'prob_1']
@@ -75,19 +70,23 @@ def make_plot(source, property_name, num_years):
 def update_plot():
     prop = prop_select.value
     p.title.text = 'Predicted Daily Occupancy For:'
-    src, num_years = get_dataset(X, prop, gbc_predict)
+    src, num_years = get_dataset(X, prop, prediction_store)
     source.data.update(src.data)
 
 
-conn = psycopg2.connect(dbname=dbname,
-                        user=username, password=password,
-                        host=host,
-                        port=port)
+# CASCADE_PLOT_BACKEND=memory serves historic data from a local cascade_hist
+# snapshot (see cascade_memory_baseline.py) instead of querying the database
+plot_backend = os.environ.get('CASCADE_PLOT_BACKEND', 'database')
+
+if plot_backend == 'memory':
+    cascade = pd.read_csv(home_path + 'data/cascade_test.csv', index_col=0)
+else:
+    from cascade_db import connection
 
-query = '''select * from cascade_test'''
+    query = '''select * from cascade_test'''
 
-cascade = pd.read_sql_query(query, conn)
-conn.close()
+    with connection() as conn:
+        cascade = pd.read_sql_query(query, conn)
 
 # cascade = pd.read_csv(home_path + '/cascade.csv', index_col=0)
 # print(cascade.shape)
@@ -98,19 +97,26 @@ X = cascade.copy()
 # print(X.shape)
 # X_train, X_test, y_train, y_test, unique_prop_codes = prepare_xy(X, [], [], True)
 # print(X_train.shape, X_test.shape, y_train.shape, y_test.shape)
-X_test, y_test = make_xy(X, [], [])
 
 prop = 'All Properties'
 start_date = str(cascade.day[0])
 
-with open(home_path+'GBC_model_1801.pkl', 'rb') as f:
-    GBC_model = pickle.load(f)
+baseline = None
+if plot_backend == 'memory':
+    from cascade_memory_baseline import build_baseline, load_hist_snapshot
+    baseline = build_baseline(load_hist_snapshot(), start_date)
+
+# Model served from the registry (see cascade_registry.py): CASCADE_MODEL
+# is its name and CASCADE_MODEL_VERSION 'latest' or a pinned version. It's
+# loaded once per server process and shared by the sessions.
+model_name = os.environ.get('CASCADE_MODEL', 'occupancy')
+model_version = os.environ.get('CASCADE_MODEL_VERSION', 'latest')
 
-gbc_predict = GBC_model.predict_proba(X_test)
+prediction_store = build_prediction_store(X, predict_proba(X, model_name, model_version))
 
-prop_select = Select(value=prop, title='Property Code', options=web_prop_list())
+prop_select = Select(value=prop, title='Property Code', options=web_prop_list(baseline))
 
-source, num_years = get_dataset(X, prop, gbc_predict)
+source, num_years = get_dataset(X, prop, prediction_store)
 p = make_plot(source, prop, num_years)
 
 prop_select.on_change('value', lambda attr, old, new: update_plot())
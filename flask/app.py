@@ -2,37 +2,52 @@ from flask import Flask, render_template, request, jsonify, make_response
 import os
 import sys
 from io import BytesIO
-import psycopg2
 import pandas as pd
 home_path = os.environ['CASCADE_HOME']
 sys.path.append(home_path + 'cascade/src')
-from cascade_plot import fetch_data_for_plotting, web_prop_list
+from cascade_plot import fetch_data_for_plotting, web_prop_list, build_prediction_store
 from cascade_model import prepare_xy, make_xy
+from cascade_registry import predict_proba
 import matplotlib
 matplotlib.use("agg")
 from cascade_matplotlib import plot_predict
-import pickle
+import threading
 import matplotlib.pyplot as plt
 
-dbname = os.environ['CASCADE_DB_DBNAME']
-host = os.environ['CASCADE_DB_HOST']
-username = os.environ['CASCADE_DB_USERNAME']
-password = os.environ['CASCADE_DB_PASSWORD']
-port = 5432
-
 app = Flask(__name__)
 
 cascade_test = pd.read_csv(home_path + 'data/cascade_test.csv', index_col=0)
 X = cascade_test.copy()
 # X_train, X_test, y_train, y_test, unique_prop_codes = prepare_xy(X, [], [], True)
-X_test, y_test = make_xy(X, [], [])
 
 property_name = 'All Properties'
 start_date = str(cascade_test.day[0])
 
-with open(home_path + 'GBC_model_1802.pkl', 'rb') as f:
-    GBC_model = pickle.load(f)
-gbc_predict = GBC_model.predict_proba(X_test)
+# CASCADE_PLOT_BACKEND=memory serves historic data from a local cascade_hist
+# snapshot (see cascade_memory_baseline.py) instead of querying the database
+plot_backend = os.environ.get('CASCADE_PLOT_BACKEND', 'database')
+baseline = None
+if plot_backend == 'memory':
+    from cascade_memory_baseline import build_baseline, load_hist_snapshot
+    baseline = build_baseline(load_hist_snapshot(), start_date)
+
+# Model served from the registry (see cascade_registry.py): CASCADE_MODEL
+# is its name and CASCADE_MODEL_VERSION 'latest' or a pinned version
+model_name = os.environ.get('CASCADE_MODEL', 'occupancy')
+model_version = os.environ.get('CASCADE_MODEL_VERSION', 'latest')
+prediction_store = None
+prediction_lock = threading.Lock()
+
+def get_prediction_store():
+    '''
+    Loads the model and scores cascade_test on first use
+    '''
+    global prediction_store
+    with prediction_lock:
+        if prediction_store is None:
+            prediction_store = build_prediction_store(X, predict_proba(X, model_name, model_version))
+
+    return prediction_store
 
 @app.route('/')
 def index():
@@ -40,7 +55,7 @@ def index():
     Retrieves the list of property list for the dropdown
     and populate it at website load
     '''
-    prop_list = web_prop_list()
+    prop_list = web_prop_list(baseline)
     return render_template('index.html',prop_list=prop_list)
 
 @app.route('/plot/<property_name>')
@@ -54,14 +69,25 @@ def _plot(property_name):
     '''
     historic, predicted, num_years = fetch_data_for_plotting(X,
                                                              property_name,
-                                                             gbc_predict,
+                                                             None,
                                                              start_date,
-                                                             True)
+                                                             True,
+                                                             baseline=baseline,
+                                                             store=get_prediction_store())
 
     plt = plot_predict(historic, predicted, property_name, num_years, False, False, True)
     image = BytesIO()
     plt.savefig(image)
     return image.getvalue(), 200, {'Content-Type': 'image/png'}
 
+@app.route('/db_metrics')
+def db_metrics():
+    '''
+    Returns the checkout metrics of the database connection pool
+    used by this process
+    '''
+    from cascade_db import pool_metrics
+    return jsonify(pool_metrics())
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', threaded=True)
@@ -0,0 +1,154 @@
+import pandas as pd
+import os
+import sys
+home_path = os.environ['CASCADE_HOME']
+sys.path.append(home_path + 'cascade/src')
+from cascade_db import get_engine
+from cascade_sql import copy_frame
+from cascade_plot import peak_year
+
+'''
+cascade_baseline holds the historic occupancy of cascade_hist aggregated by
+retail calendar coordinates, the keys the historic series are grouped by:
+- one row per property_code, month_no, week_no and day_no
+- one row per month_no, week_no and day_no for the whole fleet, under
+property_code 'All Properties'
+
+Every row has the sum of occupied and the number of days over all of
+cascade_hist (occupied_sum, day_count) and over the days of peak_year
+(peak_sum, peak_count). The historic average of a key is a single row
+instead of an aggregation over every year of cascade_hist. cascade_hist only
+holds history, it ends before the test period, so all of it is used.
+
+The table is kept up to date by refresh_baseline() whenever cascade_hist is
+loaded. After an incremental load only the keys of the changed days are
+recomputed.
+'''
+
+all_properties = 'All Properties'
+
+create_baseline_query = '''
+        create table if not exists cascade_baseline (
+            property_code text,
+            month_no integer,
+            week_no integer,
+            day_no integer,
+            occupied_sum double precision,
+            day_count integer,
+            peak_sum double precision,
+            peak_count integer,
+            primary key (property_code, month_no, week_no, day_no)
+        );
+        create index if not exists cascade_hist_day on cascade_hist (day)
+        ;'''
+
+# sum(occupied) skips nulls while count(*) doesn't: a null occupied counts as
+# a day with nothing occupied
+baseline_values = '''
+               sum(cf.occupied), count(*),
+               coalesce(sum(case when cf.year = %(peak_year)s then cf.occupied end), 0),
+               count(case when cf.year = %(peak_year)s then 1 end)'''
+
+property_baseline_query = '''
+        insert into cascade_baseline
+        select cf.property_code, rc.month_no, rc.week_no, rc.day_no,{values}
+          from cascade_hist cf
+               join retail_calendar rc
+                 on rc.day = cf.day{join}
+         group by cf.property_code, rc.month_no, rc.week_no, rc.day_no
+        ;'''
+
+fleet_baseline_query = '''
+        insert into cascade_baseline
+        select %(all_properties)s, rc.month_no, rc.week_no, rc.day_no,{values}
+          from cascade_hist cf
+               join retail_calendar rc
+                 on rc.day = cf.day{join}
+         group by rc.month_no, rc.week_no, rc.day_no
+        ;'''
+
+# Keys of the days in the changed ranges, computed once per refresh
+touched_keys_query = '''
+        create temporary table baseline_touched on commit drop as
+        select distinct r.range_key as property_code, rc.month_no, rc.week_no, rc.day_no
+          from baseline_ranges r,
+               retail_calendar rc
+         where rc.day between r.range_start and r.range_end
+        ;'''
+
+# Restricts the baseline queries to the touched keys, reading cascade_hist
+# through the days that have those coordinates
+property_touched_join = '''
+               join baseline_touched t
+                 on t.property_code = cf.property_code
+                and t.month_no = rc.month_no
+                and t.week_no = rc.week_no
+                and t.day_no = rc.day_no'''
+
+fleet_touched_join = '''
+               join (select distinct month_no, week_no, day_no from baseline_touched) t
+                 on t.month_no = rc.month_no
+                and t.week_no = rc.week_no
+                and t.day_no = rc.day_no'''
+
+def refresh_baseline(db_engine=None, ranges=None):
+    '''
+    Brings cascade_baseline in line with cascade_hist in one transaction.
+
+    Inputs
+    db_engine: instance of sqlalchemy, defaults to the shared engine
+    ranges: dataframe with property_code, start and end columns as returned
+    by cascade_merge_expand.changed_ranges(). Only the keys of the days in
+    those ranges are recomputed: the property keys of the changed property
+    and the fleet keys of the same coordinates. Keys left without any day
+    are removed. When None the whole table is rebuilt, which is also needed
+    once to replace a cascade_baseline of the older one row per day layout.
+    '''
+    if db_engine is None:
+        db_engine = get_engine()
+
+    params = {'all_properties': all_properties, 'peak_year': peak_year}
+
+    with db_engine.connect() as connection:
+        with connection.connection.cursor() as cursor:
+            cursor.execute(create_baseline_query)
+
+            if ranges is None:
+                #recreated, so that a table of an older layout is replaced
+                cursor.execute('drop table if exists cascade_baseline')
+                cursor.execute(create_baseline_query)
+                cursor.execute(property_baseline_query.format(values=baseline_values, join=''), params)
+                cursor.execute(fleet_baseline_query.format(values=baseline_values, join=''), params)
+            else:
+                cursor.execute('''
+                               create temporary table baseline_ranges (
+                                   range_key text,
+                                   range_start timestamp,
+                                   range_end timestamp
+                               ) on commit drop
+                               ''')
+                copy_frame(cursor, pd.DataFrame({'range_key': ranges['property_code'].values,
+                                                 'range_start': pd.to_datetime(ranges['start']).values,
+                                                 'range_end': pd.to_datetime(ranges['end']).values}),
+                           'baseline_ranges')
+                cursor.execute(touched_keys_query)
+
+                cursor.execute('''
+                               delete from cascade_baseline cb
+                                using baseline_touched t
+                                where cb.month_no = t.month_no
+                                  and cb.week_no = t.week_no
+                                  and cb.day_no = t.day_no
+                                  and cb.property_code in (t.property_code, %(all_properties)s)
+                               ;''', params)
+                cursor.execute(property_baseline_query.format(values=baseline_values,
+                                                              join=property_touched_join), params)
+                cursor.execute(fleet_baseline_query.format(values=baseline_values,
+                                                           join=fleet_touched_join), params)
+        connection.connection.commit()
+
+def main():
+    refresh_baseline()
+
+if __name__ == '__main__':
+    main()
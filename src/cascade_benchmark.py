@@ -0,0 +1,237 @@
+import numpy as np
+import pandas as pd
+import os
+import sys
+import time
+import tracemalloc
+from sqlalchemy import create_engine
+from sklearn.metrics import log_loss, roc_auc_score
+from sklearn.model_selection import train_test_split
+home_path = os.environ['CASCADE_HOME']
+sys.path.append(home_path + 'cascade/src')
+from cascade_data import expand_nights, expand_nights_loop
+from cascade_sql import write_to_table, copy_to_table
+from cascade_model import fit_vocabulary, make_model, engine_xy
+
+'''
+Benchmarks for the data pipeline. Each bench_* function prints its timings
+and returns them as a dataframe so that results can be compared across runs.
+'''
+
+def make_reservations(num_rows, num_properties=155, seed=127):
+    '''
+    Input
+    num_rows: number of synthetic reservations to generate
+    num_properties: number of distinct property_code values
+    seed: random seed so that runs are comparable
+
+    Output: dataframe with the same trailing column layout that
+    breakout_num_nights() expects from one_df():
+    ... num_nights, rental_rate, date, daily_rental_rate
+    '''
+    rng = np.random.RandomState(seed)
+
+    df = pd.DataFrame()
+    df['property_code'] = ['Property {}'.format(i) for i in rng.randint(0, num_properties, num_rows)]
+    df['reservation_type'] = rng.choice(['Owner', 'Guest'], num_rows)
+    df['arrival_date'] = (pd.Timestamp('2012-01-01') +
+                          pd.to_timedelta(rng.randint(0, 7 * 365, num_rows), unit='D'))
+    # LiveRez stays are mostly 1 to 7 nights with an occasional long stay
+    df['num_nights'] = np.minimum(rng.geometric(.3, num_rows), 28)
+    df['rental_rate'] = np.round(df['num_nights'] * rng.uniform(90, 400, num_rows), 2)
+    df['date'] = df['arrival_date']
+    df['daily_rental_rate'] = df['rental_rate']
+
+    return df
+
+def bench_expand_nights(base_rows=200, scales=(1, 10, 100), max_loop_rows=None):
+    '''
+    Compares expand_nights_loop() with the vectorized expand_nights() on
+    synthetic reservation sets of base_rows * scale rows.
+
+    The loop is timed at every scale, so the speedup is reported up to the
+    largest one. It's quadratic and takes minutes at 100x, max_loop_rows can
+    skip it above that many rows for a quick run. Whenever both run, their
+    outputs are checked to be identical.
+    '''
+    results = []
+    for scale in scales:
+        df = make_reservations(base_rows * scale)
+
+        start = time.time()
+        vectorized_df = expand_nights(df.copy())
+        vectorized_time = time.time() - start
+
+        loop_time = np.nan
+        if max_loop_rows is None or len(df) <= max_loop_rows:
+            start = time.time()
+            loop_df = expand_nights_loop(df.copy())
+            loop_time = time.time() - start
+
+            loop_df['date'] = pd.to_datetime(loop_df['date'])
+            for column in ['num_nights', 'rental_rate', 'daily_rental_rate']:
+                loop_df[column] = loop_df[column].astype(float)
+                vectorized_df[column] = vectorized_df[column].astype(float)
+            pd.testing.assert_frame_equal(loop_df, vectorized_df, check_dtype=False)
+
+        print("Reservations: {}, nights: {}, loop: {:.3f}s, vectorized: {:.3f}s, speedup: {:.1f}x"
+              .format(len(df), len(vectorized_df), loop_time, vectorized_time,
+                      loop_time / vectorized_time))
+
+        results.append((len(df), len(vectorized_df), loop_time, vectorized_time,
+                        loop_time / vectorized_time))
+
+    return pd.DataFrame.from_records(results, columns=['reservations', 'nights', 'loop_seconds',
+                                                       'vectorized_seconds', 'speedup'])
+
+def make_hist(num_rows, num_properties=155, seed=127):
+    '''
+    Input
+    num_rows: number of synthetic rows to generate
+    num_properties: number of distinct property_code values
+    seed: random seed so that runs are comparable
+
+    Output: dataframe with the same columns and types as cascade_hist
+    '''
+    rng = np.random.RandomState(seed)
+
+    df = pd.DataFrame()
+    df['property_code'] = ['Property {}'.format(i) for i in rng.randint(0, num_properties, num_rows)]
+    df['property_city'] = rng.choice(['Lutsen', 'Tofte', 'Grand Marais', 'Hovland'], num_rows)
+    df['property_zip'] = rng.choice([55612.0, 55615.0, 55604.0], num_rows)
+    df['series'] = rng.choice(['Moderate', 'Premium', 'Luxury'], num_rows)
+    df['num_guests'] = rng.randint(2, 14, num_rows)
+    df['num_bedrooms'] = rng.randint(1, 6, num_rows)
+    df['num_bathrooms'] = rng.randint(1, 4, num_rows) + .5 * rng.randint(0, 2, num_rows)
+    df['allows_pets'] = rng.randint(0, 2, num_rows)
+    df['property_size'] = rng.randint(400, 4000, num_rows)
+    df['manager_rating'] = np.round(rng.uniform(3, 5, num_rows), 1)
+    df['property_rating'] = np.round(rng.uniform(3, 5, num_rows), 1)
+    df['date'] = pd.Timestamp('2012-01-01') + pd.to_timedelta(rng.randint(0, 7 * 365, num_rows), unit='D')
+    df['year'] = df['date'].dt.year
+    df['month'] = df['date'].dt.month
+    df['weekend'] = ((df['date'].dt.dayofweek) // 4 == 1).astype(float)
+    df['occupied'] = rng.randint(0, 2, num_rows).astype(float)
+    df['reservation_type'] = np.where(df['occupied'] == 1, 'Guest', None)
+    df['daily_rental_rate'] = np.round(df['occupied'] * rng.uniform(90, 400, num_rows), 2)
+    df['day'] = df['date']
+
+    return df
+
+def bench_copy_to_table(address='postgresql://localhost:5432/postgres', num_rows=250000,
+                        table_name='bench_copy_to_table'):
+    '''
+    Compares write_to_table() with the streaming copy_to_table() in csv and
+    binary format, writing a synthetic cascade_hist frame to a local Postgres
+    given by address. For every writer prints rows per second and the peak
+    memory allocated while writing. The benchmark table is dropped at the end.
+    '''
+    engine = create_engine(address)
+    df = make_hist(num_rows)
+
+    writers = [('write_to_table', lambda: write_to_table(df, engine, table_name, 'replace')),
+               ('copy_to_table csv', lambda: copy_to_table(df, engine, table_name, 'replace')),
+               ('copy_to_table binary', lambda: copy_to_table(df, engine, table_name, 'replace', binary=True))]
+
+    results = []
+    for name, writer in writers:
+        tracemalloc.start()
+        start = time.time()
+        writer()
+        seconds = time.time() - start
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print("{}: {:.2f}s, {:.0f} rows/s, peak memory {:.1f} MB"
+              .format(name, seconds, num_rows / seconds, peak_memory / 2.0**20))
+        results.append((name, seconds, num_rows / seconds, peak_memory))
+
+    with engine.connect() as connection:
+        with connection.connection.cursor() as cursor:
+            cursor.execute('drop table if exists {}'.format(table_name))
+        connection.connection.commit()
+
+    return pd.DataFrame.from_records(results, columns=['writer', 'seconds', 'rows_per_second',
+                                                       'peak_memory_bytes'])
+
+def make_full(num_rows, num_properties=155, seed=127):
+    '''
+    Output: synthetic cascade_hist frame with the season and min_nights
+    columns of cascade_full, so that it has every default model feature.
+    Occupancy depends on the property, season and weekend so that the
+    models have something to learn.
+    '''
+    rng = np.random.RandomState(seed)
+
+    df = make_hist(num_rows, num_properties, seed)
+    df['season'] = np.where(df['month'].isin([6, 7, 8]), 'Summer',
+                            np.where(df['month'].isin([12, 1, 2]), 'Winter', 'Shoulder'))
+    df['min_nights'] = rng.choice([1, 2, 3, 7], num_rows)
+
+    property_effect = pd.Series(rng.normal(0, 1, num_properties),
+                                index=['Property {}'.format(i) for i in range(num_properties)])
+    logit = (property_effect[df['property_code']].values +
+             np.where(df['season'] == 'Summer', 1.0, np.where(df['season'] == 'Winter', .5, -.5)) +
+             .8 * df['weekend'].values - 1)
+    df['occupied'] = (rng.uniform(0, 1, num_rows) < 1 / (1 + np.exp(-logit))).astype(float)
+
+    return df
+
+def bench_engines(num_rows=50000, engines=('gbc', 'hist', 'lr'), params=None, df=None):
+    '''
+    Compares the model engines of cascade_model.make_model() on the same
+    train/test split (same rows and random state as prepare_xy()).
+
+    Inputs
+    num_rows: size of the synthetic data set when df isn't given
+    engines: engines to compare
+    params: dictionary of engine to parameter overrides, e.g. to shorten the
+    benchmark with {'gbc': {'n_estimators': 100}, 'hist': {'max_iter': 100}}
+    df: data to use instead of make_full(num_rows), e.g. cascade_full
+
+    For every engine prints fit time, predict_proba time of the test set and
+    of a single row (mean of 100 calls), log loss and AUC.
+    '''
+    if df is None:
+        df = make_full(num_rows)
+    if params is None:
+        params = {}
+
+    df_train, df_test = train_test_split(df, test_size=0.2, random_state=127)
+    vocabulary = fit_vocabulary(df_train)
+
+    results = []
+    for engine in engines:
+        X_train, y_train = engine_xy(df_train, vocabulary, engine)
+        X_test, y_test = engine_xy(df_test, vocabulary, engine)
+        model = make_model(engine, vocabulary, **params.get(engine, {}))
+
+        start = time.time()
+        model.fit(X_train, y_train)
+        fit_seconds = time.time() - start
+
+        start = time.time()
+        prob = model.predict_proba(X_test)[:, 1]
+        predict_seconds = time.time() - start
+
+        single_row = X_test[:1]
+        start = time.time()
+        for i in range(100):
+            model.predict_proba(single_row)
+        row_ms = (time.time() - start) * 10
+
+        loss = log_loss(y_test, prob)
+        auc = roc_auc_score(y_test, prob)
+
+        print("{}: fit {:.2f}s, predict {:.3f}s ({} rows), single row {:.2f}ms, log loss {:.4f}, AUC {:.4f}"
+              .format(engine, fit_seconds, predict_seconds, len(y_test), row_ms, loss, auc))
+        results.append((engine, fit_seconds, predict_seconds, row_ms, loss, auc))
+
+    return pd.DataFrame.from_records(results, columns=['engine', 'fit_seconds', 'predict_seconds',
+                                                       'single_row_ms', 'log_loss', 'auc'])
+
+if __name__ == '__main__':
+    bench_expand_nights()
+    bench_engines(params={'gbc': {'n_estimators': 100}, 'hist': {'max_iter': 100}})
+    if len(sys.argv) > 1:
+        bench_copy_to_table(sys.argv[1])
@@ -0,0 +1,189 @@
+import numpy as np
+import pandas as pd
+import os
+import sys
+import time
+from multiprocessing import Pool
+from sklearn.metrics import log_loss, roc_auc_score, accuracy_score
+home_path = os.environ['CASCADE_HOME']
+sys.path.append(home_path + 'cascade/src')
+from cascade_model import fit_vocabulary, make_model, engine_xy
+from cascade_retail_calendar import add_retail_calendar
+
+'''
+Time series cross validation. Shuffled K fold lets a model train on days
+that come after the ones it's scored on; rolling origin folds always train
+on the past and test on what comes next, the way the model is used to
+forecast the next season:
+
+    train: ... | test: origin | (next origin)
+    train: ...     origin     | test: next origin
+
+Folds are made by calendar year (year_folds) or by retail calendar period
+(period_folds). As in cascade_model.split_by_year, properties that aren't
+in the training window are dropped from the test rows. Folds are then fitted
+in parallel by cross_validate_folds().
+'''
+
+def drop_unseen(df, train_index, test_index):
+    '''
+    Output: test_index without the rows of properties that don't appear in
+    train_index
+    '''
+    seen = df['property_code'].values[train_index]
+    test_codes = df['property_code'].values[test_index]
+
+    return test_index[np.isin(test_codes, np.unique(seen))]
+
+def year_folds(df, min_train_years=2, window=None, test_years=None):
+    '''
+    Inputs
+    df: dataframe with year and property_code columns, e.g. cascade_full
+    min_train_years: years of history before the first test year
+    window: years of training data, None to train on all the years before
+    the test year (expanding window)
+    test_years: years to test on, defaults to every year after
+    min_train_years
+
+    Output: list of (name, train_index, test_index) with positional indices
+    into df
+    '''
+    years = df['year'].values
+    all_years = np.unique(years)
+
+    if test_years is None:
+        test_years = all_years[min_train_years:]
+
+    folds = []
+    for test_year in test_years:
+        first_year = all_years[0] if window is None else test_year - window
+        train_index = np.flatnonzero((years < test_year) & (years >= first_year))
+        test_index = drop_unseen(df, train_index, np.flatnonzero(years == test_year))
+        folds.append(('year {}'.format(test_year), train_index, test_index))
+
+    return folds
+
+def retail_periods(df, period='quarter', date_column='day'):
+    '''
+    Output: integer array with the retail calendar period of every row,
+    consecutive periods have consecutive numbers
+    period: 'month' (4-5-4 months), 'quarter' (13 weeks) or 'year'
+    '''
+    calendar = add_retail_calendar(df[[date_column]].copy(), date_column)
+    retail_year = calendar['retail_year'].values.astype(int)
+    month_index = calendar['month_no'].values.astype(int) - 1
+
+    if period == 'month':
+        return retail_year * 12 + month_index
+    if period == 'quarter':
+        return retail_year * 4 + month_index // 3
+    if period == 'year':
+        return retail_year
+
+    raise ValueError("Unknown period: {}".format(period))
+
+def period_name(period, index):
+    '''
+    Output: readable name of a period number from retail_periods(), e.g.
+    'retail 2017 Q2' or 'retail 2017 M05'
+    '''
+    if period == 'month':
+        return 'retail {} M{:02d}'.format(index // 12, index % 12 + 1)
+    if period == 'quarter':
+        return 'retail {} Q{}'.format(index // 4, index % 4 + 1)
+
+    return 'retail {}'.format(index)
+
+def period_folds(df, period='quarter', num_folds=4, horizon=1, window=None, date_column='day'):
+    '''
+    Inputs
+    df: dataframe with a date column and property_code
+    period: retail calendar period of a fold, see retail_periods()
+    num_folds: number of origins, the last num_folds periods with data
+    horizon: periods tested after each origin
+    window: periods of training data, None for an expanding window
+
+    Output: list of (name, train_index, test_index) with positional indices
+    into df
+    '''
+    periods = retail_periods(df, period, date_column)
+    all_periods = np.unique(periods)
+    origins = all_periods[-(num_folds + horizon - 1):len(all_periods) - horizon + 1]
+
+    folds = []
+    for origin in origins:
+        first_period = all_periods[0] if window is None else origin - window
+        train_index = np.flatnonzero((periods < origin) & (periods >= first_period))
+        test_index = np.flatnonzero((periods >= origin) & (periods < origin + horizon))
+        if len(train_index) == 0:
+            continue
+        test_index = drop_unseen(df, train_index, test_index)
+        folds.append((period_name(period, origin), train_index, test_index))
+
+    return folds
+
+# Data shared with the fold workers. It's set once per process by
+# init_fold_worker instead of being sent along with every fold.
+fold_data = {}
+
+def init_fold_worker(df, engine, params):
+    fold_data['df'] = df
+    fold_data['engine'] = engine
+    fold_data['params'] = params
+
+def fit_fold(fold):
+    '''
+    Fits and scores one fold on the data set by init_fold_worker(). The
+    vocabulary is fitted on the training rows only.
+    '''
+    name, train_index, test_index = fold
+    df = fold_data['df']
+    engine = fold_data['engine']
+
+    df_train = df.iloc[train_index]
+    df_test = df.iloc[test_index]
+    vocabulary = fit_vocabulary(df_train)
+    X_train, y_train = engine_xy(df_train, vocabulary, engine)
+    X_test, y_test = engine_xy(df_test, vocabulary, engine)
+
+    model = make_model(engine, vocabulary, **fold_data['params'])
+
+    start = time.time()
+    model.fit(X_train, y_train)
+    fit_seconds = time.time() - start
+
+    prob = model.predict_proba(X_test)[:, 1]
+
+    return (name, len(train_index), len(test_index),
+            log_loss(y_test, prob, labels=[0, 1]),
+            accuracy_score(y_test, prob > .5),
+            roc_auc_score(y_test, prob) if len(np.unique(y_test)) > 1 else np.nan,
+            fit_seconds)
+
+def cross_validate_folds(df, folds, engine='gbc', params=None, processes=None):
+    '''
+    Inputs
+    df: data set the folds index into
+    folds: as returned by year_folds() or period_folds()
+    engine, params: model to fit, see cascade_model.make_model()
+    processes: number of folds fitted at a time, defaults to the number of
+    cpus. The 'hist' engine is multi-threaded itself, use fewer processes
+    with it.
+
+    Output: dataframe with one row of metrics per fold
+    '''
+    if params is None:
+        params = {}
+
+    if processes == 1:
+        init_fold_worker(df, engine, params)
+        results = [fit_fold(fold) for fold in folds]
+    else:
+        with Pool(processes, initializer=init_fold_worker, initargs=(df, engine, params)) as pool:
+            results = pool.map(fit_fold, folds, chunksize=1)
+
+    results = pd.DataFrame.from_records(results, columns=['fold', 'train_rows', 'test_rows', 'log_loss',
+                                                          'accuracy', 'AUC_score', 'fit_seconds'])
+    print(results)
+
+    return results
@@ -1,7 +1,27 @@
 import pandas as pd
 import numpy as np
 import os
+import glob
+import hashlib
+import inspect
+from multiprocessing import Pool
 home_path = os.environ['CASCADE_HOME']
+cache_path = home_path + 'data/cache/'
+
+# Declared types for the sales cycle columns the pipeline relies on.
+# Keys are cleaned up column names (see columns_cleanup). Columns that
+# are not listed here are left to pandas type inference.
+sales_cycle_dtypes = {'property_code': str,
+                      'reservation_type': str,
+                      'arrival_date': str,
+                      'rental_rate': np.float64}
+
+def clean_column_name(column):
+    '''
+    Input: raw column name from a sales cycle file
+    Output: cleaned up column name as described in columns_cleanup()
+    '''
+    return column.lower().replace(' ', '_').replace('(', '').replace(')', '').replace('#', 'num').replace('/', '_').replace('-', '_')
 
 def columns_cleanup(df):
     '''
@@ -16,9 +36,32 @@ def columns_cleanup(df):
     5. replace '/' with underscore
     6. replace '-' with underscore
     '''
-    df.columns = [c.lower().replace(' ', '_').replace('(', '').replace(')', '').replace('#', 'num').replace('/', '_').replace('-', '_') for c in df.columns]
+    df.columns = [clean_column_name(c) for c in df.columns]
     return df
 
+def sales_cycle_file(year):
+    '''
+    Input: two digit year of the sales cycle file
+    Output: path and encoding to use when reading the file
+
+    For year 2017 and 2018, source data was encoded differently and had to
+    apply encoding of 'latin-1' when reading from csv.
+    '''
+    year = int(year)
+    path = home_path + 'data/{}salescycle.csv'.format(year)
+    encoding = 'latin-1' if year in (17, 18) else None
+
+    return path, encoding
+
+def read_header(year):
+    '''
+    Input: two digit year of the sales cycle file
+    Output: list of raw column names. Only the header line is parsed.
+    '''
+    path, encoding = sales_cycle_file(year)
+
+    return list(pd.read_csv(path, encoding=encoding, nrows=0).columns)
+
 def read_csv(year, columns):
     '''
     Input:
@@ -27,25 +70,26 @@ def read_csv(year, columns):
 
     Output: dataframe with read data from csv for corresponding year.
 
-    columns_cleanup() function is called to clean up column names
+    Only the requested columns are parsed (usecols) using the types declared
+    in sales_cycle_dtypes, so dropped columns such as guest information and
+    taxes are never read. Column names are cleaned up with columns_cleanup().
 
     Note that for files with year greater than year 2014, there is an extra column
-    called integration_tax that will be removed.
-
-    For year 2017, source data was encoded differently and had to apply
-    ending of 'latin-1' when reading from csv.
-
+    called integration_tax that is never read.
     '''
     year = int(year)
-    if year in (17, 18):
-        df = pd.read_csv(home_path + 'data/{}salescycle.csv'.format(year), encoding='latin-1')
-    else:
-        df = pd.read_csv(home_path + 'data/{}salescycle.csv'.format(year))
-
-    df = columns_cleanup(df)
+    path, encoding = sales_cycle_file(year)
 
+    raw_columns = read_header(year)
+    clean_to_raw = {clean_column_name(c): c for c in raw_columns}
     if year > 14:
-        df = df.drop('integration_tax', axis=1)
+        clean_to_raw.pop('integration_tax', None)
+
+    usecols = [clean_to_raw[c] for c in columns if c in clean_to_raw]
+    dtype = {clean_to_raw[c]: t for c, t in sales_cycle_dtypes.items() if c in columns and c in clean_to_raw}
+
+    df = pd.read_csv(path, encoding=encoding, usecols=usecols, dtype=dtype)
+    df = columns_cleanup(df)
 
     df = df[columns]
 
@@ -54,15 +98,91 @@ def read_csv(year, columns):
 
     return df[:-1]
 
-def one_df(years, columns):
+def file_digest(path, block_size=2**20):
+    '''
+    Input: path of the file to hash
+    Output: sha1 hex digest of the file content
+    '''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+def cache_key(year, columns):
+    '''
+    Input: two digit year of the sales cycle file and list of columns as
+    defined by list_columns() function
+    Output: key that identifies the cleaned up data for the given year
+
+    The key combines the content of the source file, the requested columns
+    and the source of the functions and types that clean up the data, so any
+    change to one of them invalidates the cached data.
+    '''
+    path, encoding = sales_cycle_file(year)
+    rules = [inspect.getsource(f) for f in (clean_column_name, columns_cleanup, sales_cycle_file, read_csv)]
+    rules.append(repr(sorted((c, str(t)) for c, t in sales_cycle_dtypes.items())))
+
+    sha1 = hashlib.sha1()
+    sha1.update(file_digest(path).encode())
+    sha1.update('|'.join(columns).encode())
+    sha1.update('\n'.join(rules).encode())
+
+    return sha1.hexdigest()[:16]
+
+def cached_read_csv(year, columns):
+    '''
+    Input: same as read_csv()
+    Output: same dataframe as read_csv()
+
+    Cleaned up data for every year is stored as parquet in data/cache/ under
+    its cache_key(). Years whose source file, columns and cleanup rules have
+    not changed are loaded from there, otherwise read_csv() is called and the
+    stale cache file for the year is replaced.
+    '''
+    year = int(year)
+    cache_file = cache_path + '{}salescycle-{}.parquet'.format(year, cache_key(year, columns))
+
+    if os.path.exists(cache_file):
+        df = pd.read_parquet(cache_file)
+        print("Loaded year {} from cache: {} rows".format(year, len(df)))
+        return df
+
+    df = read_csv(year, columns)
+
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+    for stale_file in glob.glob(cache_path + '{}salescycle-*.parquet'.format(year)):
+        os.remove(stale_file)
+
+    try:
+        #write to a temporary file first so that a partial write is never
+        #picked up as a valid cache file
+        df.to_parquet(cache_file + '.tmp')
+        os.replace(cache_file + '.tmp', cache_file)
+    except (ImportError, ValueError, TypeError) as e:
+        print("Could not cache year {}: {}".format(year, e))
+
+    return df
+
+def one_df(years, columns, processes=None, use_cache=True):
     '''
     Input: list of years corresponding to individual file
+    columns: list of columns as defined by list_columns() function
+    processes: number of worker processes used to read the yearly files.
+    Defaults to one per cpu; 1 reads the files one after another.
+    use_cache: load unchanged years from the cache (see cached_read_csv)
     Output: one dataframe to rule them all
 
     '''
-    frames = []
-    for year in years:
-        frames.append(read_csv(year, columns))
+    reader = cached_read_csv if use_cache else read_csv
+    args = [(year, columns) for year in years]
+    if processes == 1:
+        frames = [reader(*arg) for arg in args]
+    else:
+        with Pool(processes) as pool:
+            frames = pool.starmap(reader, args)
 
     df = pd.concat(frames)
     df['arrival_date'] = pd.to_datetime(df['arrival_date'], format="%m/%d/%Y", errors='ignore')
@@ -76,12 +196,13 @@ def list_columns():
 
     Because of recent changes in the source file format in which number of columns
     seemed to have dropped, using 2017 data file as a basis for columns for the
-    dataframe.
+    dataframe. Only its header is read.
     Note that because integration_tax column was introduced in 2015 onwards, it's
     dropped from the final column list
     '''
 
-    columns = list(columns_cleanup(pd.read_csv(home_path + 'data/17salescycle.csv', encoding='latin-1')).columns)
+    columns = [clean_column_name(c) for c in read_header(17)]
+
     columns_to_remove = {'property_address','property_country', 'property_state', 'property_country',
                          'location_id','agent','company_name','first_name',
                          'last_name','phone','cell_phone','email','address','city','state','zip',
@@ -98,29 +219,24 @@ def list_columns():
 
     return columns
 
-def breakout_num_nights(df):
+def expand_nights_loop(df):
     '''
-    Input: A pandas dataframe the contains initial cascade information that
-    contains arrival_date and num_nights
-    Output: A pandas dataframe that contains additional rows that correspond to
-    arrival date + num_nights for given property_code
+    Input: A pandas dataframe as returned by one_df() with daily_rental_rate
+    column already added
+    Output: A pandas dataframe that contains one row per rented night
 
     Method: 1. Make a numpy array from input pandas dataframe
             2. Make a copy of numpy array from step 1
             3. Iterate through as many records there are in the numpy array
-            4. if the num_nights (in the current array, the position is -2) is greater than 1
+            4. if the num_nights (in the current array, the position is -4) is greater than 1
                 create additional row using np.vstack
             5. Update the date of the newly created row by adding a day
             6. Convert the numpy array into a pandas dataframe
-    '''
-    # cascade_header is a file that contains name of property_code and
-    # its corresponding url for detail scraping.
-    # Using it here to get the name of valid property code and remove
-    # historic ones that are no longer managed by the company
-    cascade_head = pd.read_csv(home_path + 'data/cascade_header.csv')
-    cascade_head = cascade_head.drop('Unnamed: 0', axis=1)
 
-    df['daily_rental_rate'] = df['rental_rate']
+    This is the original implementation. Every np.vstack copies the whole
+    array so it is quadratic in the number of output rows. It is kept as a
+    reference for expand_nights() and for benchmarking.
+    '''
     columns = df.columns
     numpy_df = df.values
     np_df = numpy_df.copy()
@@ -138,7 +254,65 @@ def breakout_num_nights(df):
                 #Populating daily rental rate by dividing rental_rate [-3] by num_nights [-4]
                 numpy_df[-1][-1] = float(numpy_df[-1][-3])/int(numpy_df[-1][-4])
 
-    return_df = pd.DataFrame(numpy_df, columns=columns)
+    return pd.DataFrame(numpy_df, columns=columns)
+
+def expand_nights(df):
+    '''
+    Input: A pandas dataframe as returned by one_df() with daily_rental_rate
+    column already added
+    Output: A pandas dataframe that contains one row per rented night
+
+    Vectorized version of expand_nights_loop() that produces the same rows
+    in the same order:
+    1. original reservations first, with daily_rental_rate set to
+       rental_rate / num_nights when num_nights is greater than 1
+    2. followed by the extra nights of every multi night reservation, in
+       reservation order, each one dated arrival + 1, 2, ... num_nights - 1
+    '''
+    nights = df['num_nights'].values
+    multi = nights > 1
+
+    rental_rate = df['rental_rate'].values
+    daily_rate = np.where(multi, rental_rate.astype(float) / np.where(multi, nights, 1), rental_rate)
+
+    #Position of the source reservation for every extra night
+    extra_counts = (nights[multi] - 1).astype(int)
+    extra_rows = np.repeat(np.flatnonzero(multi), extra_counts)
+    #Day offset of every extra night within its reservation: 1 .. num_nights - 1
+    extra_starts = np.cumsum(extra_counts) - extra_counts
+    extra_offsets = np.arange(len(extra_rows)) - np.repeat(extra_starts, extra_counts) + 1
+
+    rows = np.concatenate([np.arange(len(df)), extra_rows])
+    offsets = np.concatenate([np.zeros(len(df), dtype=int), extra_offsets])
+
+    return_df = df.iloc[rows].reset_index(drop=True)
+    return_df['date'] = pd.to_datetime(return_df['date']) + pd.to_timedelta(offsets, unit='D')
+    return_df['daily_rental_rate'] = np.concatenate([daily_rate, daily_rate[extra_rows]])
+
+    return return_df
+
+def breakout_num_nights(df, vectorized=True):
+    '''
+    Input: A pandas dataframe the contains initial cascade information that
+    contains arrival_date and num_nights
+    vectorized: use expand_nights() instead of the original np.vstack loop
+    in expand_nights_loop(). Both produce the same rows.
+    Output: A pandas dataframe that contains additional rows that correspond to
+    arrival date + num_nights for given property_code
+    '''
+    # cascade_header is a file that contains name of property_code and
+    # its corresponding url for detail scraping.
+    # Using it here to get the name of valid property code and remove
+    # historic ones that are no longer managed by the company
+    cascade_head = pd.read_csv(home_path + 'data/cascade_header.csv')
+    cascade_head = cascade_head.drop('Unnamed: 0', axis=1)
+
+    df['daily_rental_rate'] = df['rental_rate']
+
+    if vectorized:
+        return_df = expand_nights(df)
+    else:
+        return_df = expand_nights_loop(df)
 
     #Drop unnecesary columns
     return_df = return_df.drop(['arrival_date', 'num_nights', 'rental_rate'], axis=1)
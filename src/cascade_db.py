@@ -0,0 +1,195 @@
+import os
+import argparse
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+
+'''
+Shared database access layer. Every module and app goes through one pooled
+sqlalchemy engine per process instead of opening its own connections:
+- get_engine() for pandas/sqlalchemy users such as write_to_table
+- connection() for plain psycopg2 connections, e.g. pd.read_sql_query
+
+Pool size can be configured with the following environment variables
+CASCADE_DB_POOL_SIZE: connections kept open (default 5)
+CASCADE_DB_POOL_OVERFLOW: extra connections opened under load (default 10)
+CASCADE_DB_POOL_TIMEOUT: seconds to wait for a free connection (default 30)
+
+Loaders stamp the tables they reload in cascade_refresh_log with
+record_refresh(), so that readers caching data derived from those tables can
+check last_refresh() to know when their cache is stale.
+'''
+
+dbname = os.environ['CASCADE_DB_DBNAME']
+host = os.environ['CASCADE_DB_HOST']
+username = os.environ['CASCADE_DB_USERNAME']
+password = os.environ['CASCADE_DB_PASSWORD']
+port = 5432
+
+pool_size = int(os.environ.get('CASCADE_DB_POOL_SIZE', 5))
+pool_overflow = int(os.environ.get('CASCADE_DB_POOL_OVERFLOW', 10))
+pool_timeout = int(os.environ.get('CASCADE_DB_POOL_TIMEOUT', 30))
+
+engine = None
+engine_pid = None
+engine_lock = threading.Lock()
+# Engines inherited from a parent process, see get_engine()
+inherited_engines = []
+
+metrics_lock = threading.Lock()
+metrics = {'connections_created': 0,
+           'checkouts': 0,
+           'checkins': 0,
+           'in_use': 0,
+           'peak_in_use': 0,
+           'checkout_wait_seconds': 0.0,
+           'max_checkout_wait_seconds': 0.0}
+
+def on_connect(dbapi_connection, connection_record):
+    with metrics_lock:
+        metrics['connections_created'] += 1
+
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    with metrics_lock:
+        metrics['checkouts'] += 1
+        metrics['in_use'] += 1
+        metrics['peak_in_use'] = max(metrics['peak_in_use'], metrics['in_use'])
+
+def on_checkin(dbapi_connection, connection_record):
+    with metrics_lock:
+        metrics['checkins'] += 1
+        metrics['in_use'] -= 1
+
+def get_engine():
+    '''
+    Output: the sqlalchemy engine shared by the current process.
+
+    It's created on first use. A forked process (e.g. a worker of a
+    multiprocessing pool or a web server) gets its own engine as connections
+    can't be shared across processes. The engine inherited from the parent
+    is disposed with close=False and kept referenced, so that neither the
+    dispose nor garbage collection in the child closes the sockets the
+    parent is still using.
+    '''
+    global engine, engine_pid
+
+    with engine_lock:
+        if engine is not None and engine_pid != os.getpid():
+            engine.dispose(close=False)
+            inherited_engines.append(engine)
+            engine = None
+
+        if engine is None:
+            address = 'postgresql://{}:{}@{}:{}/{}'.format(username, password, host, port, dbname)
+            engine = create_engine(address,
+                                   pool_size=pool_size,
+                                   max_overflow=pool_overflow,
+                                   pool_timeout=pool_timeout,
+                                   pool_pre_ping=True)
+            event.listen(engine, 'connect', on_connect)
+            event.listen(engine, 'checkout', on_checkout)
+            event.listen(engine, 'checkin', on_checkin)
+            engine_pid = os.getpid()
+
+            with metrics_lock:
+                for name in metrics:
+                    metrics[name] = 0
+
+    return engine
+
+@contextmanager
+def connection():
+    '''
+    Checks out a psycopg2 connection from the shared pool, e.g.
+
+        with connection() as conn:
+            df = pd.read_sql_query(query, conn)
+
+    The transaction is committed when the block exits normally and rolled
+    back on error, then the connection goes back to the pool.
+    '''
+    start = time.time()
+    conn = get_engine().raw_connection()
+    wait = time.time() - start
+
+    with metrics_lock:
+        metrics['checkout_wait_seconds'] += wait
+        metrics['max_checkout_wait_seconds'] = max(metrics['max_checkout_wait_seconds'], wait)
+
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def pool_metrics():
+    '''
+    Output: dictionary with the checkout metrics of the current process
+    pool and its configuration
+    '''
+    with metrics_lock:
+        current = dict(metrics)
+
+    checkouts = current['checkouts']
+    current['mean_checkout_wait_seconds'] = current['checkout_wait_seconds'] / checkouts if checkouts else 0.0
+    current['pool_size'] = pool_size
+    current['pool_overflow'] = pool_overflow
+    current['pool_status'] = engine.pool.status() if engine is not None else 'not created'
+
+    return current
+
+create_refresh_log_query = '''
+        create table if not exists cascade_refresh_log (
+            table_name text primary key,
+            refreshed_at timestamp not null
+        )
+        ;'''
+
+def record_refresh(table_name):
+    '''
+    Stamps table_name as reloaded now in cascade_refresh_log. Call it once
+    the load of the table has been committed.
+    '''
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(create_refresh_log_query)
+            cursor.execute('''
+                           insert into cascade_refresh_log (table_name, refreshed_at)
+                           values (%s, now())
+                           on conflict (table_name)
+                           do update set refreshed_at = excluded.refreshed_at
+                           ;''', (table_name,))
+
+def last_refresh(table_name):
+    '''
+    Output: datetime at which table_name was last stamped by
+    record_refresh(), None if it never was
+    '''
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("select to_regclass('cascade_refresh_log')")
+            if cursor.fetchone()[0] is None:
+                return None
+
+            cursor.execute('''
+                           select refreshed_at
+                             from cascade_refresh_log
+                            where table_name = %s
+                           ;''', (table_name,))
+            row = cursor.fetchone()
+
+    return row[0] if row else None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cascade database helpers')
+    parser.add_argument('--record-refresh', metavar='TABLE',
+                        help='stamp a table reloaded outside of these modules, e.g. cascade_full')
+    args = parser.parse_args()
+
+    if args.record_refresh:
+        record_refresh(args.record_refresh)
+        print("{} refreshed at {}".format(args.record_refresh, last_refresh(args.record_refresh)))
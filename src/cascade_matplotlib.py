@@ -3,7 +3,6 @@ import pandas as pd
 import matplotlib
 matplotlib.use("agg")
 import matplotlib.pyplot as plt
-import psycopg2
 import os
 from cascade_model import prepare_xy
 from cascade_plot import fetch_data_for_plotting
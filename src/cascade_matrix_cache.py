@@ -0,0 +1,226 @@
+import numpy as np
+import pandas as pd
+import os
+import sys
+import glob
+import shutil
+import hashlib
+import inspect
+import pickle
+from scipy import sparse as sp
+home_path = os.environ['CASCADE_HOME']
+sys.path.append(home_path + 'cascade/src')
+from cascade_model import fit_vocabulary, make_vocabulary, encode_xy, split_by_year, prepare_xy
+from cascade_model import default_features
+from sklearn.model_selection import train_test_split
+
+'''
+Disk cache of the sparse design matrices built by cascade_model.encode_xy().
+
+Matrices are keyed by (data snapshot, columns, dummy, split mode) and stored
+under data/matrix_cache/<key>/ as .npy files that are loaded memory mapped,
+so that take_one and the apps stop re-encoding the same data every run.
+
+Only the matrix with every feature is ever encoded. Each feature owns a
+block of columns in it (a single column for a numeric feature, one column
+per category for a dummied one), and the matrix without some features is
+the full matrix with their blocks dropped, see drop_features().
+'''
+
+matrix_cache_path = home_path + 'data/matrix_cache/'
+
+def data_digest(df):
+    '''
+    Input: dataframe the matrices are built from
+    Output: sha1 hex digest of its content, column names and types. Use it
+    as the snapshot of load_matrices() when the data has no better version.
+    '''
+    sha1 = hashlib.sha1()
+    sha1.update(repr([(c, str(t)) for c, t in df.dtypes.items()]).encode())
+    sha1.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+
+    return sha1.hexdigest()
+
+def matrix_key(snapshot, columns, dummy, split, test_year):
+    '''
+    Output: key that identifies the matrices of a data snapshot for the given
+    features and split. The source of the encoding and split functions is
+    part of the key so any change to them invalidates the cached matrices.
+    '''
+    rules = [inspect.getsource(f) for f in (default_features, fit_vocabulary, make_vocabulary,
+                                            encode_xy, split_by_year, prepare_xy)]
+
+    sha1 = hashlib.sha1()
+    sha1.update(snapshot.encode())
+    sha1.update('|'.join(columns).encode())
+    sha1.update('|'.join(dummy).encode())
+    sha1.update('{}|{}'.format(split, test_year).encode())
+    sha1.update('\n'.join(rules).encode())
+
+    return sha1.hexdigest()[:16]
+
+def feature_blocks(vocabulary):
+    '''
+    Input: vocabulary as returned by fit_vocabulary()
+    Output: dictionary of feature name to the array of its column indices in
+    the design matrix
+    '''
+    blocks = {}
+    for i, column in enumerate(vocabulary['numeric']):
+        blocks[column] = np.array([i])
+
+    offset = len(vocabulary['numeric'])
+    for column in vocabulary['dummy']:
+        width = len(vocabulary['categories'][column])
+        blocks[column] = np.arange(offset, offset + width)
+        offset += width
+
+    return blocks
+
+def save_csr(X, path, name):
+    np.save(path + name + '_data.npy', X.data)
+    np.save(path + name + '_indices.npy', X.indices)
+    np.save(path + name + '_indptr.npy', X.indptr)
+
+def load_csr(path, name, shape):
+    return sp.csr_matrix((np.load(path + name + '_data.npy', mmap_mode='r'),
+                          np.load(path + name + '_indices.npy', mmap_mode='r'),
+                          np.load(path + name + '_indptr.npy', mmap_mode='r')),
+                         shape=shape, copy=False)
+
+def build_matrices(df, columns, dummy, split, test_year):
+    '''
+    Inputs
+    split: 'year' or 'random' to split the same way as prepare_xy() with and
+    without year_split, 'none' to encode all of df as X_train, y_train with
+    empty X_test, y_test
+
+    Output: dictionary with X_train, X_test, y_train and y_test, the
+    vocabulary and the unique property codes
+    '''
+    unique_property_codes = []
+
+    if split == 'none':
+        vocabulary = fit_vocabulary(df, columns, dummy)
+        X_train, y_train = encode_xy(df, vocabulary)
+        X_test, y_test = X_train[:0], np.array([])
+    elif split == 'year':
+        df_train, df_test, property_code_to_remove = split_by_year(df, test_year)
+        unique_property_codes = df_train.property_code.unique()
+        vocabulary = fit_vocabulary(df_train, columns, dummy)
+        X_train, y_train = encode_xy(df_train, vocabulary)
+        X_test, y_test = encode_xy(df_test, vocabulary)
+    else:
+        vocabulary = fit_vocabulary(df, columns, dummy)
+        X, y = encode_xy(df, vocabulary)
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2,
+                                                            random_state=127)
+
+    #y is None when df has no occupied column, e.g. data to score
+    if y_train is None:
+        y_train = np.array([])
+
+    return {'X_train': X_train,
+            'X_test': X_test,
+            'y_train': np.asarray(y_train),
+            'y_test': np.asarray(y_test),
+            'vocabulary': vocabulary,
+            'unique_property_codes': np.asarray(unique_property_codes)}
+
+def load_matrices(df, columns=[], dummy=[], year_split=False, test_year=2017, snapshot=None,
+                  split=None):
+    '''
+    Inputs
+    df: dataframe to build the matrices from, e.g. cascade_full
+    columns, dummy, year_split, test_year: same as prepare_xy()
+    snapshot: identifies the version of df. Defaults to data_digest(df)
+    split: overrides year_split, see build_matrices()
+
+    Output: dictionary with X_train and X_test as CSR matrices backed by
+    memory mapped files, y_train, y_test, the vocabulary, the unique
+    property codes as in prepare_xy() and the feature blocks.
+
+    Matrices are loaded from the cache when present, otherwise built with
+    every feature of columns and stored.
+    '''
+    columns, dummy = default_features(columns, dummy)
+
+    if snapshot is None:
+        snapshot = data_digest(df)
+
+    if split is None:
+        split = 'year' if year_split else 'random'
+
+    key = matrix_key(snapshot, columns, dummy, split, test_year)
+    path = matrix_cache_path + key + '/'
+
+    if not os.path.exists(path):
+        matrices = build_matrices(df, columns, dummy, split, test_year)
+
+        #written to a temporary directory first so that an interrupted write
+        #is never picked up as a valid cache entry
+        tmp_path = matrix_cache_path + key + '.tmp{}/'.format(os.getpid())
+        os.makedirs(tmp_path)
+        save_csr(matrices['X_train'], tmp_path, 'X_train')
+        save_csr(matrices['X_test'], tmp_path, 'X_test')
+        np.save(tmp_path + 'y_train.npy', matrices['y_train'])
+        np.save(tmp_path + 'y_test.npy', matrices['y_test'])
+        np.save(tmp_path + 'unique_property_codes.npy', matrices['unique_property_codes'].astype(str))
+        with open(tmp_path + 'meta.pkl', 'wb') as f:
+            pickle.dump({'vocabulary': matrices['vocabulary'],
+                         'X_train_shape': matrices['X_train'].shape,
+                         'X_test_shape': matrices['X_test'].shape}, f)
+
+        try:
+            os.rename(tmp_path, path)
+            print("Cached design matrices {}".format(key))
+        except OSError:
+            #another process cached the same matrices first
+            shutil.rmtree(tmp_path)
+
+    with open(path + 'meta.pkl', 'rb') as f:
+        meta = pickle.load(f)
+
+    return {'X_train': load_csr(path, 'X_train', meta['X_train_shape']),
+            'X_test': load_csr(path, 'X_test', meta['X_test_shape']),
+            'y_train': np.load(path + 'y_train.npy', mmap_mode='r'),
+            'y_test': np.load(path + 'y_test.npy', mmap_mode='r'),
+            'vocabulary': meta['vocabulary'],
+            'unique_property_codes': np.load(path + 'unique_property_codes.npy'),
+            'blocks': feature_blocks(meta['vocabulary'])}
+
+def load_xy(df, columns=[], dummy=[], snapshot=None):
+    '''
+    Cached version of cascade_model.encode_xy() with a vocabulary fitted on
+    df. Not meant for scoring: the columns depend on df, score with the
+    vocabulary the model was trained with instead.
+
+    Output: X as a memory mapped CSR matrix, y and the vocabulary
+    '''
+    matrices = load_matrices(df, columns, dummy, snapshot=snapshot, split='none')
+
+    return matrices['X_train'], matrices['y_train'], matrices['vocabulary']
+
+def drop_features(matrices, features):
+    '''
+    Inputs
+    matrices: as returned by load_matrices()
+    features: list of features to remove
+
+    Output: X_train, X_test, y_train, y_test without the column blocks of
+    the given features. Same columns as prepare_xy() with the features
+    removed from columns and dummy.
+    '''
+    drop = [matrices['blocks'][feature] for feature in features if feature in matrices['blocks']]
+    keep = np.setdiff1d(np.arange(matrices['X_train'].shape[1]),
+                        np.concatenate(drop) if drop else [])
+
+    return (matrices['X_train'][:, keep], matrices['X_test'][:, keep],
+            matrices['y_train'], matrices['y_test'])
+
+def clear_matrix_cache():
+    '''
+    Removes every cached matrix.
+    '''
+    for path in glob.glob(matrix_cache_path + '*'):
+        shutil.rmtree(path)
@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+import os
+import sys
+home_path = os.environ['CASCADE_HOME']
+sys.path.append(home_path + 'cascade/src')
+from cascade_retail_calendar import lookup_coordinates
+from cascade_plot import all_properties, peak_months, peak_year, peak_divisor
+
+'''
+In memory alternative to the historic queries of cascade_plot. cascade_hist
+is loaded once from a local snapshot and the historic averages by retail
+calendar coordinates are computed with np.bincount, so that the apps can
+serve historic series without a database.
+
+Every (property, month_no, week_no, day_no) is encoded as one integer key:
+property index * slots_per_property + the position of the coordinates in a
+12 months x 53 weeks x 7 days grid. All Properties takes the last property
+index. Averages of a key are then sums[key] / counts[key].
+
+Use
+    baseline = build_baseline(load_hist_snapshot(), start_date)
+    fetch_data_for_plotting(df, property_name, prob, start_date, full_year,
+                            baseline=baseline)
+'''
+
+hist_snapshot_path = home_path + 'data/cascade_hist_snapshot.parquet'
+hist_columns = ['property_code', 'day', 'year', 'occupied']
+
+num_months = 12
+num_weeks = 53
+num_days = 7
+slots_per_property = num_months * num_weeks * num_days
+
+def save_hist_snapshot(path=hist_snapshot_path):
+    '''
+    Writes the columns of cascade_hist needed by build_baseline() to a local
+    parquet file. This is the only step that needs the database.
+    '''
+    # Imported here so that the rest of the module works without any
+    # database configuration
+    from cascade_db import connection
+
+    query = 'select {} from cascade_hist'.format(', '.join(hist_columns))
+
+    with connection() as conn:
+        hist = pd.read_sql_query(query, conn)
+
+    hist.to_parquet(path, index=False)
+    print("Saved {} rows of cascade_hist to {}".format(len(hist), path))
+
+def load_hist_snapshot(path=hist_snapshot_path):
+    '''
+    Output: dataframe with property_code, day, year and occupied columns as
+    saved by save_hist_snapshot()
+    '''
+    hist = pd.read_parquet(path, columns=hist_columns)
+    hist['day'] = pd.to_datetime(hist['day'])
+
+    return hist
+
+def encode_keys(property_index, coordinates):
+    '''
+    Inputs
+    property_index: integer array, index of the property of every row
+    coordinates: array with retail_year, month_no, week_no and day_no
+    columns as returned by lookup_coordinates()
+
+    Output: integer array of keys into the sums and counts of a baseline
+    '''
+    coordinates = coordinates.astype(np.int64)
+    slot = ((coordinates[:, 1] - 1) * num_weeks + coordinates[:, 2] - 1) * num_days + coordinates[:, 3] - 1
+
+    return property_index.astype(np.int64) * slots_per_property + slot
+
+def sum_and_count(keys, occupied, mask, minlength):
+    '''
+    Output: (sums, counts) of occupied for every key over the rows in mask.
+    A null occupied counts as a day with nothing occupied.
+    '''
+    sums = np.bincount(keys[mask], weights=occupied[mask], minlength=minlength)
+    counts = np.bincount(keys[mask], minlength=minlength)
+
+    return sums, counts
+
+def build_baseline(hist, start_date, peak_year=peak_year):
+    '''
+    Inputs
+    hist: dataframe with property_code, day, year and occupied columns,
+    e.g. load_hist_snapshot()
+    start_date: first day of the predictions. Only history before that date
+    is used, same as cascade_plot.historic_query()
+    peak_year: year the peak series are compared to
+
+    Output: dictionary with the sums and counts of every key for the full
+    year ('full') and the peak year ('peak'), and per property its number of
+    years of history and first day
+    '''
+    hist = hist[pd.to_datetime(hist['day']) < pd.Timestamp(start_date)]
+
+    property_index, properties = pd.factorize(hist['property_code'])
+    properties = pd.Index(list(properties) + [all_properties])
+    fleet_index = np.full(len(hist), len(properties) - 1)
+
+    coordinates = lookup_coordinates(pd.to_datetime(hist['day']).values)
+    keys = np.concatenate([encode_keys(property_index, coordinates),
+                           encode_keys(fleet_index, coordinates)])
+    occupied = np.tile(np.nan_to_num(hist['occupied'].values.astype(float)), 2)
+    minlength = len(properties) * slots_per_property
+
+    full_year = np.ones(len(keys), dtype=bool)
+    peak = np.tile(hist['year'].values == peak_year, 2)
+
+    by_property = hist.groupby('property_code')
+
+    return {'properties': properties,
+            'start_date': pd.Timestamp(start_date),
+            'full': sum_and_count(keys, occupied, full_year, minlength),
+            'peak': sum_and_count(keys, occupied, peak, minlength),
+            'num_years': (by_property['year'].nunique() - 1).to_dict(),
+            'first_day': by_property['day'].min().to_dict()}
+
+def memory_historic(baseline, df, property_names=None, full_year=True):
+    '''
+    Inputs
+    baseline: as returned by build_baseline()
+    df: dataframe with property_code, day and month columns of the days to
+    plot, i.e. cascade_test
+    property_names: list of property names, may include 'All Properties'.
+    None returns every property in df and All Properties.
+    full_year: whether the series covers the full year from the start date
+    of the baseline or only the peak months
+
+    Output: same dictionary as cascade_plot.fetch_historic()
+    '''
+    days = df[['property_code', 'day', 'month']].copy()
+    days['day'] = pd.to_datetime(days['day'])
+
+    if full_year:
+        days = days[days['day'] >= baseline['start_date']]
+        sums, counts = baseline['full']
+    else:
+        days = days[days['month'].isin(peak_months)]
+        sums, counts = baseline['peak']
+
+    if property_names is None:
+        property_names = list(days['property_code'].unique()) + [all_properties]
+
+    # Same test days as the test_days part of the historic query: distinct
+    # days per property, and all days under All Properties
+    fleet_days = days[['day']].drop_duplicates()
+    fleet_days['property_code'] = all_properties
+    days = pd.concat([days[['property_code', 'day']].drop_duplicates(), fleet_days])
+    days = days[days['property_code'].isin(property_names)]
+
+    property_index = baseline['properties'].get_indexer(days['property_code'])
+    days = days[property_index >= 0]
+    property_index = property_index[property_index >= 0]
+
+    keys = encode_keys(property_index, lookup_coordinates(days['day'].values))
+    days = days.assign(occupied=sums[keys] / np.maximum(counts[keys], 1))[counts[keys] > 0]
+
+    # At most a year of days per property
+    days = days.sort_values(['property_code', 'day'])
+    max_days = np.where(days['property_code'] == all_properties, 365 if full_year else 366, 366)
+    days = days[days.groupby('property_code').cumcount().values < max_days]
+
+    if not full_year:
+        days['occupied'] = np.divide(days['occupied'], peak_divisor)
+
+    series = dict(list(days.groupby('property_code')))
+
+    result = {}
+    for property_name in property_names:
+        if property_name == all_properties:
+            num_years = (2,)
+        else:
+            num_years = (baseline['num_years'].get(property_name, -1),)
+
+        historic_occupied = series.get(property_name, days.iloc[:0])[['day', 'occupied']]
+        historic_occupied = historic_occupied.set_index('day')
+
+        result[property_name] = (historic_occupied, num_years)
+
+    return result
+
+def memory_prop_list(baseline):
+    '''
+    Same list as cascade_plot.web_prop_list(): All Properties and every
+    property with more than 2 years of history.
+    '''
+    cutoff = pd.Timestamp.today().normalize() - pd.Timedelta(days=732)
+    eligible = sorted(p for p, first_day in baseline['first_day'].items() if first_day < cutoff)
+
+    return [all_properties] + eligible
+
+if __name__ == '__main__':
+    save_hist_snapshot()
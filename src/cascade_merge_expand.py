@@ -1,33 +1,79 @@
 import pandas as pd
+import numpy as np
 import os
 import sys
-from sqlalchemy import create_engine
+import argparse
 home_path = os.environ['CASCADE_HOME']
 sys.path.append(home_path + 'cascade/src')
-from cascade_sql import write_to_table
+from cascade_sql import write_to_table, copy_to_table, bulk_load, write_partitions, replace_ranges
+from cascade_db import get_engine, record_refresh
+from cascade_baseline import refresh_baseline
 
-dbname = os.environ['CASCADE_DB_DBNAME']
-host = os.environ['CASCADE_DB_HOST']
-username = os.environ['CASCADE_DB_USERNAME']
-password = os.environ['CASCADE_DB_PASSWORD']
-port = 5432
+# Nightly occupancy rows as of the last load of cascade_hist.
+# Incremental refreshes are diffed against it.
+snapshot_path = home_path + 'data/cascade_more_snapshot.parquet'
+snapshot_columns = ['property_code', 'date', 'reservation_type', 'daily_rental_rate', 'occupied']
 
-def merge_and_expand():
+def load_cascade_more():
     '''
-    This function will merge a dataframe that contains historical
-    occupancy information per property_code (cascade_more.csv) with
-    a dataframe that contains property features information
-    (cascade_details.csv)
+    Output: dataframe that contains historical occupancy information per
+    property_code and night (cascade_more.csv)
+    '''
+    #retrieving file that contains historic occupancy info
+    return pd.read_csv(home_path + 'data/cascade_more.csv',
+                       infer_datetime_format=True, index_col=0)
 
-    Output: merged and exploded dataframe that account for all calendar days
-    for a given property_code. For each property_code the calendar starts
-    from its first occupancy date.
+def calendar_grid(cascade_join, columns):
     '''
+    Inputs
+    cascade_join: dataframe with one row per occupied night (date column) and
+    property_code
+    columns: columns to carry over to every calendar day
 
-    #retrieving file that contains historic occupancy info
-    cascade_more = pd.read_csv(home_path + 'data/cascade_more.csv',
-                               infer_datetime_format=True, index_col=0)
+    Output: dataframe with one row per property_code and calendar day, from
+    its first to its last occupied night, sorted by property_code and date.
+    Every calendar day takes the values of columns from the last occupied
+    night on or before it.
+
+    This is the same as doing resample('D').ffill() per property_code and
+    concatenating the results, but the whole grid is built at once.
+    '''
+    nights = cascade_join[columns].copy()
+    nights['date'] = pd.to_datetime(cascade_join['date'])
+    nights = nights.sort_values(['property_code', 'date'], kind='mergesort').reset_index(drop=True)
+
+    #first and last occupied night per property_code
+    bounds = nights.groupby('property_code').date.agg(['min', 'max'])
+    num_days = ((bounds['max'] - bounds['min']).dt.days + 1).values
+
+    #one row per property_code and calendar day
+    grid_prop = np.repeat(np.arange(len(bounds)), num_days)
+    grid_starts = np.cumsum(num_days) - num_days
+    grid_offsets = np.arange(num_days.sum()) - np.repeat(grid_starts, num_days)
+    grid_date = (np.repeat(bounds['min'].values.astype('datetime64[D]'), num_days) +
+                 grid_offsets.astype('timedelta64[D]'))
+
+    #encode (property_code, day) as a single sortable integer so that the
+    #last occupied night on or before every calendar day can be found with
+    #one searchsorted call
+    first_day = nights['date'].values.astype('datetime64[D]').min()
+    span = (grid_date.max() - first_day).astype(int) + 1
+    night_prop = bounds.index.get_indexer(nights['property_code'])
+    night_key = night_prop * span + (nights['date'].values.astype('datetime64[D]') - first_day).astype(int)
+    grid_key = grid_prop * span + (grid_date - first_day).astype(int)
+    source = np.searchsorted(night_key, grid_key, side='right') - 1
+
+    full_cal_df = nights[columns].iloc[source].reset_index(drop=True)
+    #set date column to equal the calendar date.
+    full_cal_df['date'] = pd.to_datetime(grid_date.astype('datetime64[ns]'))
+
+    return full_cal_df
 
+def load_cascade_details():
+    '''
+    Output: dataframe that contains property features information
+    (prop_head.csv) for the properties that are part of the analysis
+    '''
     #processing file that contains property features
     #It turns out that following 8 properties should not be part of
     #this analysis
@@ -41,6 +87,30 @@ def merge_and_expand():
     #records pertaining to remove_list are removed from dataframe
     cascade_details = cascade_details[~cascade_details['property_code'].isin(remove_list)]
 
+    return cascade_details
+
+def merge_and_expand(cascade_more=None, cascade_details=None):
+    '''
+    This function will merge a dataframe that contains historical
+    occupancy information per property_code (cascade_more.csv) with
+    a dataframe that contains property features information
+    (cascade_details.csv)
+
+    Input
+    cascade_more: historical occupancy dataframe. Read from cascade_more.csv
+    when not passed in.
+    cascade_details: property features dataframe. Read with
+    load_cascade_details() when not passed in.
+
+    Output: merged and exploded dataframe that account for all calendar days
+    for a given property_code. For each property_code the calendar starts
+    from its first occupancy date.
+    '''
+    if cascade_more is None:
+        cascade_more = load_cascade_more()
+
+    if cascade_details is None:
+        cascade_details = load_cascade_details()
 
     #Join cascade_more and cascade_detail dataframes on property_code
     #This new dataframe, cascade_join will contain a row that combines all
@@ -50,37 +120,13 @@ def merge_and_expand():
     cascade_join.allows_pets = cascade_join.allows_pets.map(dict(Yes=1, No=0))
 
 
-    #Retrieve unique property_code name so that we can loop through each
-    #of them to fill any holes in calendar when the property was not
-    #occupied
-    unique_prop_code = sorted(list(cascade_join.property_code.unique()))
-
     #Columns to be included in the final_dataframe
     columns = ['property_code', 'property_city', 'property_zip', 'series',
                'num_guests', 'num_bedrooms', 'num_bathrooms', 'allows_pets',
                'property_size', 'manager_rating', 'property_rating']
 
-    #Instantiating an empty dataframe
-    final_df = pd.DataFrame()
-
-    for prop_code in unique_prop_code:
-        #Create a temp dataframe for each loop per property code
-        temp_df = cascade_join[cascade_join['property_code'] == prop_code]
-        #Set the index to be date
-        temp_df.index = pd.to_datetime(temp_df['date'])
-
-        #Another temp dataframe for resampling and foward filling of
-        #records for all calendar date
-        full_cal_df = pd.DataFrame()
-        full_cal_df[columns] = temp_df[columns].resample('D').ffill()
-        #set date column to equal the index which is calendar date.
-        full_cal_df['date'] = full_cal_df.index
-
-        #merge fully processed temporary dataframe to final dataframe.
-        final_df = pd.concat([final_df, full_cal_df], axis=0)
-
-    #drop the time (calendar date) index and reset it with numeric value
-    final_df = final_df.reset_index(drop=True)
+    #fill any holes in calendar when the property was not occupied
+    final_df = calendar_grid(cascade_join, columns)
 
     #make sure that date column is of type datetime
     final_df['date'] = pd.to_datetime(final_df['date'])
@@ -123,14 +169,212 @@ def merge_and_expand():
 
     return final_df
 
-def main():
-    df = merge_and_expand()
-    # df.to_csv(home_path+ 'data/cascade_expanded.csv')
+def merge_and_expand_partitions(cascade_more=None, partition_size=20):
+    '''
+    Generator version of merge_and_expand() that yields the merged and
+    exploded dataframe partition_size properties at a time, in property_code
+    order. Only one partition is expanded in memory at any time, so peak
+    memory doesn't grow with the number of properties.
 
-    address = 'postgresql://{}:{}@{}:{}/{}'.format(username, password, host, port, dbname)
-    engine = create_engine(address)
+    Note that column types are inferred per partition, a sink that creates
+    its table from the first partition relies on every partition having the
+    same types.
+    '''
+    if cascade_more is None:
+        cascade_more = load_cascade_more()
 
-    write_to_table(df, engine, 'cascade_hist', if_exists='replace')
+    cascade_details = load_cascade_details()
+
+    prop_codes = sorted(set(cascade_more['property_code']) & set(cascade_details['property_code']))
+
+    for i in range(0, len(prop_codes), partition_size):
+        partition = prop_codes[i:i + partition_size]
+        yield merge_and_expand(cascade_more[cascade_more['property_code'].isin(partition)].copy(),
+                               cascade_details[cascade_details['property_code'].isin(partition)])
+
+def write_partitions_to_csv(partitions, path):
+    '''
+    Writes every dataframe yielded by partitions to one csv file at path,
+    with a single header line.
+    '''
+    num_rows = 0
+    for i, df in enumerate(partitions):
+        df.to_csv(path, mode='w' if i == 0 else 'a', header=(i == 0), index=False)
+        num_rows += len(df)
+        print("Partition {}: {} rows".format(i, len(df)))
+
+    return num_rows
+
+def night_digests(cascade_more):
+    '''
+    Input: historical occupancy dataframe (cascade_more)
+    Output: dataframe with one row per (property_code, date) and a digest of
+    all the nightly rows for that key
+    '''
+    nights = cascade_more[snapshot_columns].copy()
+    nights['date'] = pd.to_datetime(nights['date'])
+    nights['daily_rental_rate'] = nights['daily_rental_rate'].astype(float)
+    nights['occupied'] = nights['occupied'].astype(float)
+
+    nights['digest'] = pd.util.hash_pandas_object(nights, index=False).values
+
+    return nights.groupby(['property_code', 'date']).digest.sum().reset_index()
+
+def calendar_bounds(cascade_more):
+    '''
+    Output: dataframe indexed by property_code with the first and last
+    night of its calendar (min and max columns)
+    '''
+    return pd.to_datetime(cascade_more['date']).groupby(cascade_more['property_code']).agg(['min', 'max'])
+
+def changed_ranges(previous, current):
+    '''
+    Inputs
+    previous: historical occupancy dataframe that was last loaded to the database
+    current: historical occupancy dataframe to be loaded
+
+    Output: dataframe with property_code, start and end columns, the
+    non-overlapping ranges of calendar days whose rows change, sorted by
+    property_code and start.
+
+    Property features are the same on every day of a property, so a calendar
+    day only depends on the night of that same day, if any. The rows that
+    change are the nights added, removed or modified, plus the days that
+    enter or leave the calendar when its first or last night moves: a new
+    last night after a gap adds the whole gap, a cancelled last night drops
+    the days after the new last night.
+    '''
+    digests = pd.concat([night_digests(previous), night_digests(current)])
+    #nights that are identical on both sides show up twice and are dropped
+    changed = digests.drop_duplicates(keep=False)[['property_code', 'date']].drop_duplicates()
+
+    one_day = pd.Timedelta(days=1)
+    bounds = calendar_bounds(previous).join(calendar_bounds(current), how='outer',
+                                            lsuffix='_old', rsuffix='_new')
+    bounds = bounds[bounds.index.isin(changed['property_code'])]
+    old_min, old_max = bounds['min_old'], bounds['max_old']
+    new_min, new_max = bounds['min_new'], bounds['max_new']
+
+    #days only in the new calendar, or only in the old one, at each end. A
+    #property missing on one side gets its whole calendar from the other.
+    edges = [(new_min, (old_min - one_day).fillna(new_max)),
+             (old_max + one_day, new_max),
+             (old_min, (new_min - one_day).fillna(old_max)),
+             (new_max + one_day, old_max)]
+
+    ranges = [pd.DataFrame({'property_code': changed['property_code'].values,
+                            'start': changed['date'].values,
+                            'end': changed['date'].values})]
+    for start, end in edges:
+        ranges.append(pd.DataFrame({'property_code': bounds.index, 'start': start.values, 'end': end.values}))
+
+    ranges = pd.concat(ranges, ignore_index=True).dropna()
+    ranges = ranges[ranges['start'] <= ranges['end']].sort_values(['property_code', 'start'])
+
+    #merge ranges that overlap or touch
+    previous_end = ranges.groupby('property_code')['end'].transform(lambda end: end.cummax().shift())
+    run = (previous_end.isnull() | (ranges['start'] > previous_end + one_day)).cumsum()
+    ranges = ranges.groupby(run.values).agg({'property_code': 'first', 'start': 'min', 'end': 'max'})
+
+    return ranges.reset_index(drop=True)
+
+def range_days(ranges):
+    '''
+    Output: dataframe with one (property_code, day) row per calendar day of
+    every range of changed_ranges()
+    '''
+    num_days = ((ranges['end'] - ranges['start']).dt.days + 1).values
+    starts = np.cumsum(num_days) - num_days
+    offsets = np.arange(num_days.sum()) - np.repeat(starts, num_days)
+
+    return pd.DataFrame({'property_code': np.repeat(ranges['property_code'].values, num_days),
+                         'day': (np.repeat(ranges['start'].values.astype('datetime64[D]'), num_days) +
+                                 offsets.astype('timedelta64[D]')).astype('datetime64[ns]')})
+
+def incremental_expand(previous, cascade_more):
+    '''
+    Inputs
+    previous: historical occupancy dataframe that was last loaded to the database
+    cascade_more: historical occupancy dataframe to be loaded
+
+    Output: changed_ranges() and the merged and expanded rows that fall in
+    those ranges
+
+    Only the properties that changed are expanded, and only the rows in
+    their changed ranges are kept. Deleting the rows of the ranges and
+    appending these rows brings cascade_hist in line with a full rebuild.
+    '''
+    ranges = changed_ranges(previous, cascade_more)
+
+    changed_more = cascade_more[cascade_more['property_code'].isin(ranges['property_code'])].copy()
+    if len(changed_more) == 0:
+        return ranges, pd.DataFrame()
+
+    final_df = merge_and_expand(changed_more)
+    final_df = pd.merge(final_df, range_days(ranges), on=['property_code', 'day'], how='inner')
+
+    return ranges, final_df
+
+def main(incremental=False, streaming=False, upsert=False, num_streams=1):
+    '''
+    Loads cascade_hist.
+
+    incremental: only rewrite the (property_code, day) ranges that changed
+    since the last load (see snapshot_path). Falls back to a full rebuild
+    when there is no snapshot yet.
+    streaming: for a full rebuild, expand and load the table a partition of
+    properties at a time (see merge_and_expand_partitions)
+    upsert: for a full rebuild, merge the rows into cascade_hist on
+    (property_code, day) instead of replacing the table, so that only changed
+    rows are written, rows no longer in any calendar are deleted and readers
+    never see an empty table
+    num_streams: for a full rebuild, load the table with that many parallel
+    COPY streams split by year (see cascade_sql.bulk_load)
+    '''
+    engine = get_engine()
+
+    cascade_more = load_cascade_more()
+
+    if incremental and os.path.exists(snapshot_path):
+        previous = pd.read_parquet(snapshot_path)
+        ranges, df = incremental_expand(previous, cascade_more)
+        print("Properties changed: {}, ranges: {}, rows rewritten: {}"
+              .format(ranges['property_code'].nunique(), len(ranges), len(df)))
+        if len(ranges) == 0:
+            return
+
+        replace_ranges(df, engine, 'cascade_hist', ranges)
+        refresh_baseline(engine, ranges)
+    elif streaming:
+        write_partitions(merge_and_expand_partitions(cascade_more), engine, 'cascade_hist')
+        refresh_baseline(engine)
+    else:
+        df = merge_and_expand(cascade_more)
+        # df.to_csv(home_path+ 'data/cascade_expanded.csv')
+
+        if upsert:
+            copy_to_table(df, engine, 'cascade_hist', 'upsert', key=['property_code', 'day'])
+        elif num_streams > 1:
+            bulk_load(df, engine, 'cascade_hist', partition_column='year', num_streams=num_streams)
+        else:
+            write_to_table(df, engine, 'cascade_hist', if_exists='replace')
+
+        refresh_baseline(engine)
+
+    record_refresh('cascade_hist')
+    cascade_more[snapshot_columns].to_parquet(snapshot_path)
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Loads cascade_hist')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only rewrite the ranges that changed since the last load')
+    parser.add_argument('--streaming', action='store_true',
+                        help='expand and load a partition of properties at a time')
+    parser.add_argument('--upsert', action='store_true',
+                        help='merge into cascade_hist instead of replacing it')
+    parser.add_argument('--streams', type=int, default=1,
+                        help='number of parallel COPY streams for a full rebuild')
+    args = parser.parse_args()
+
+    main(incremental=args.incremental, streaming=args.streaming,
+         upsert=args.upsert, num_streams=args.streams)
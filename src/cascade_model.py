@@ -1,6 +1,33 @@
 import numpy as np
 import pandas as pd
+import pickle
+from scipy import sparse as sp
 from sklearn.model_selection import train_test_split
+from sklearn.ensemble import GradientBoostingClassifier, HistGradientBoostingClassifier
+from sklearn.linear_model import LogisticRegression
+
+# Features used when make_xy() isn't given any
+default_columns = ['property_code','property_city', 'property_zip', 'series',
+                   'num_guests', 'num_bedrooms', 'num_bathrooms', 'allows_pets',
+                   'manager_rating', 'property_rating', 'weekend', 'season',
+                   'min_nights']
+
+default_dummy = ['property_code','property_city',
+                 'property_zip', 'series',
+                 'num_guests', 'num_bedrooms',
+                 'num_bathrooms', 'season', 'min_nights']
+
+def default_features(columns, dummy):
+    '''
+    Output: columns and dummy, each replaced by its default when empty
+    '''
+    if len(columns) == 0:
+        columns = default_columns
+
+    if len(dummy) == 0:
+        dummy = default_dummy
+
+    return columns, dummy
 
 def make_xy(df, columns, dummy):
     '''
@@ -12,17 +39,7 @@ def make_xy(df, columns, dummy):
     columns: indicates which columns need to be included in the final X dataframe
     dummy: features that need to be dummied by pandas
     '''
-    if len(columns) == 0:
-        columns =['property_code','property_city', 'property_zip', 'series',
-                  'num_guests', 'num_bedrooms', 'num_bathrooms', 'allows_pets',
-                  'manager_rating', 'property_rating', 'weekend', 'season',
-                  'min_nights']
-
-    if len(dummy) == 0:
-        dummy = ['property_code','property_city',
-                 'property_zip', 'series',
-                 'num_guests', 'num_bedrooms',
-                 'num_bathrooms', 'season', 'min_nights']
+    columns, dummy = default_features(columns, dummy)
 
     X = df[columns]
     X = pd.get_dummies(X, columns=dummy)
@@ -31,6 +48,185 @@ def make_xy(df, columns, dummy):
 
     return X, y
 
+def fit_vocabulary(df, columns=[], dummy=[]):
+    '''
+    Learns the categories of the dummy features once so that train and
+    serving design matrices always have the same columns.
+
+    Inputs
+    df: dataframe to learn the categories from
+    columns, dummy: same as make_xy()
+
+    Output: vocabulary dictionary, see make_vocabulary()
+    '''
+    columns, dummy = default_features(columns, dummy)
+
+    categories = {column: df[column].dropna().unique() for column in dummy}
+
+    return make_vocabulary(columns, dummy, categories)
+
+def make_vocabulary(columns, dummy, categories):
+    '''
+    Inputs
+    columns, dummy: same as make_xy()
+    categories: dictionary of dummy feature to its distinct values
+
+    Output: vocabulary dictionary with
+    columns, dummy: the features used
+    numeric: the columns that aren't dummied, in columns order
+    categories: sorted categories of every dummy feature
+    feature_names: names of the design matrix columns, same names and order
+    as pd.get_dummies in make_xy()
+    '''
+    columns, dummy = default_features(columns, dummy)
+
+    numeric = [column for column in columns if column not in dummy]
+    sorted_categories = {}
+    feature_names = list(numeric)
+
+    for column in dummy:
+        sorted_categories[column] = list(np.sort(np.asarray(categories[column])))
+        feature_names += ['{}_{}'.format(column, value) for value in sorted_categories[column]]
+
+    return {'columns': list(columns),
+            'dummy': list(dummy),
+            'numeric': numeric,
+            'categories': sorted_categories,
+            'feature_names': feature_names}
+
+def code_categories(df, vocabulary):
+    '''
+    Inputs
+    df: dataframe with the features of the vocabulary
+    vocabulary: as returned by fit_vocabulary()
+
+    Output: compact dataframe with the numeric features as they are and
+    every dummy feature replaced by the integer code of its category in the
+    vocabulary, -1 for missing or unknown categories
+    '''
+    X = df[vocabulary['numeric']].copy()
+
+    for column in vocabulary['dummy']:
+        codes = pd.Categorical(df[column], categories=vocabulary['categories'][column]).codes
+        X[column] = codes.astype(np.int16 if len(vocabulary['categories'][column]) < 2**15 else np.int32)
+
+    return X[[column for column in vocabulary['columns']]]
+
+def encode_xy(df, vocabulary):
+    '''
+    Sparse version of make_xy() with a fixed vocabulary.
+
+    Inputs
+    df: dataframe to split into X, y
+    vocabulary: as returned by fit_vocabulary()
+
+    Output: X as a scipy CSR matrix with vocabulary['feature_names'] columns
+    and y. Categories that are missing or not in the vocabulary have all
+    their dummy columns set to 0, as pd.get_dummies does with missing
+    values. y is None when df has no occupied column.
+    '''
+    num_rows = len(df)
+    rows = []
+    cols = []
+    data = []
+
+    for i, column in enumerate(vocabulary['numeric']):
+        values = df[column].values.astype(float)
+        nonzero = np.flatnonzero(values)
+        rows.append(nonzero)
+        cols.append(np.full(len(nonzero), i))
+        data.append(values[nonzero])
+
+    offset = len(vocabulary['numeric'])
+    for column in vocabulary['dummy']:
+        codes = pd.Categorical(df[column], categories=vocabulary['categories'][column]).codes
+        known = np.flatnonzero(codes >= 0)
+        rows.append(known)
+        cols.append(offset + codes[known].astype(np.int64))
+        data.append(np.ones(len(known)))
+        offset += len(vocabulary['categories'][column])
+
+    X = sp.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                      shape=(num_rows, offset))
+
+    y = df['occupied'] if 'occupied' in df.columns else None
+
+    return X, y
+
+def save_vocabulary(vocabulary, path):
+    '''
+    Saves a vocabulary next to the model it was used to train, e.g.
+    save_vocabulary(vocabulary, home_path + 'GBC_model_1802_vocabulary.pkl')
+    '''
+    with open(path, 'wb') as f:
+        pickle.dump(vocabulary, f)
+
+def load_vocabulary(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def categorical_mask(vocabulary):
+    '''
+    Output: boolean list, True for the columns of code_categories() that hold
+    category codes
+    '''
+    return [column in vocabulary['dummy'] for column in vocabulary['columns']]
+
+def make_model(engine='gbc', vocabulary=None, **params):
+    '''
+    Inputs
+    engine: which model to build
+    'gbc' - GradientBoostingClassifier with the production settings, fitted
+    on the one-hot matrix of make_xy() or encode_xy()
+    'hist' - HistGradientBoostingClassifier, multi-threaded, fitted on the
+    integer codes of code_categories() with the dummy features handled as
+    native categoricals
+    'lr' - LogisticRegression baseline, fitted on the one-hot matrix
+    vocabulary: required by 'hist' to know which columns are categorical
+    params: overrides of the default parameters of the engine
+
+    Output: unfitted model. Use engine_xy() to build its matrices.
+    '''
+    if engine == 'gbc':
+        defaults = {'learning_rate': .05,
+                    'n_estimators': 1000,
+                    'max_depth': 10,
+                    'subsample': 1,
+                    'max_features': 'sqrt',
+                    'random_state': 1}
+        defaults.update(params)
+        return GradientBoostingClassifier(**defaults)
+
+    if engine == 'hist':
+        if vocabulary is None:
+            raise ValueError("engine 'hist' needs the vocabulary of its categorical features")
+
+        #the number of categories of a feature has to fit in max_bins
+        defaults = {'learning_rate': .05,
+                    'max_iter': 1000,
+                    'max_depth': 10,
+                    'early_stopping': False,
+                    'categorical_features': categorical_mask(vocabulary),
+                    'random_state': 1}
+        defaults.update(params)
+        return HistGradientBoostingClassifier(**defaults)
+
+    if engine == 'lr':
+        return LogisticRegression(**params)
+
+    raise ValueError("Unknown engine: {}".format(engine))
+
+def engine_xy(df, vocabulary, engine='gbc'):
+    '''
+    Output: X, y of df in the form make_model(engine) is fitted on, integer
+    codes for 'hist' and the sparse one-hot matrix otherwise
+    '''
+    if engine == 'hist':
+        y = df['occupied'] if 'occupied' in df.columns else None
+        return code_categories(df, vocabulary), y
+
+    return encode_xy(df, vocabulary)
+
 def split_by_year(df, test_year=2017):
     '''
     As the name indicates, dataframe will be split by year
@@ -56,7 +252,8 @@ def split_by_year(df, test_year=2017):
 
     return df_train, df_test, property_code_to_remove
 
-def prepare_xy(df, columns=[], dummy=[], year_split=False, test_year=2017):
+def prepare_xy(df, columns=[], dummy=[], year_split=False, test_year=2017,
+               sparse=False, vocabulary=None):
     '''
     Inputs
     df: dataframe to split into train and test set
@@ -65,6 +262,11 @@ def prepare_xy(df, columns=[], dummy=[], year_split=False, test_year=2017):
     year_split: indicates whether the train/test set needs to be split along year
     In current scenario, split will be historical date between 2012 to 2016 as train
     while test will be 2017.
+    sparse: X_train and X_test are scipy CSR matrices built by encode_xy()
+    instead of dummied dataframes
+    vocabulary: vocabulary to encode with when sparse. When None it's fitted
+    on the train years for a year split and on df otherwise. Pass one from
+    fit_vocabulary() to keep it for serving.
 
     Output: returns X_train, X_test, y_train, y_test and unique property codes
     as in the case of preparing splits, if data is split into years, it'll need
@@ -76,11 +278,22 @@ def prepare_xy(df, columns=[], dummy=[], year_split=False, test_year=2017):
     if year_split:
         df_train, df_test, property_code_to_remove = split_by_year(df, test_year)
         unique_property_codes = df_train.property_code.unique()
-        X_train, y_train = make_xy(df_train, columns, dummy)
-        X_test, y_test = make_xy(df_test, columns, dummy)
+        if sparse:
+            if vocabulary is None:
+                vocabulary = fit_vocabulary(df_train, columns, dummy)
+            X_train, y_train = encode_xy(df_train, vocabulary)
+            X_test, y_test = encode_xy(df_test, vocabulary)
+        else:
+            X_train, y_train = make_xy(df_train, columns, dummy)
+            X_test, y_test = make_xy(df_test, columns, dummy)
 
     else:
-        X, y = make_xy(df, columns, dummy)
+        if sparse:
+            if vocabulary is None:
+                vocabulary = fit_vocabulary(df, columns, dummy)
+            X, y = encode_xy(df, vocabulary)
+        else:
+            X, y = make_xy(df, columns, dummy)
         X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2,
                                                             random_state=127)
 
@@ -1,116 +1,230 @@
 import numpy as np
 import pandas as pd
-import psycopg2
 import os
 import sys
-from sqlalchemy import create_engine
+import threading
+import time
 
 home_path = os.environ['CASCADE_HOME']
 sys.path.append(home_path + 'cascade/src')
 from cascade_model import prepare_xy, make_xy
-from cascade_sql import write_to_table
 
-dbname = os.environ['CASCADE_DB_DBNAME']
-host = os.environ['CASCADE_DB_HOST']
-username = os.environ['CASCADE_DB_USERNAME']
-password = os.environ['CASCADE_DB_PASSWORD']
-port = 5432
+all_properties = 'All Properties'
 
-'''
-For readability purposes, storing sql queries as grobal variables
+# Peak season months and the historic year it's compared to
+peak_months = [6, 7, 8, 9, 10]
+peak_year = 2017
+peak_divisor = 2.5
+
+# web_prop_list() is cached for CASCADE_PROP_LIST_TTL seconds (default 1 hr)
+# and reloaded sooner when cascade_full, the table it's queried from, is
+# reloaded. The refresh stamp of cascade_full is checked at most every
+# CASCADE_PROP_LIST_CHECK seconds. cascade_full is built outside of these
+# modules, its load has to stamp it with
+#     python cascade_db.py --record-refresh cascade_full
+prop_list_ttl = int(os.environ.get('CASCADE_PROP_LIST_TTL', 3600))
+prop_list_check = int(os.environ.get('CASCADE_PROP_LIST_CHECK', 60))
+prop_list_lock = threading.Lock()
+prop_list_cache = {'prop_list': None, 'loaded_at': 0.0, 'checked_at': 0.0, 'refreshed_at': None}
 
-TO DO:
-There is a more efficient way to organize these
-queries that are very similar
 '''
+Historic series are built by historic_query() from the following pieces.
+Historic averages are read from cascade_baseline (see cascade_baseline.py)
+which holds cascade_hist already aggregated by retail calendar coordinates
+per property and for all properties, one row per series key.
+'''
+
+# Properties to fetch: either the given list or every property in cascade_test
+# plus All Properties
+listed_properties = '''
+                select unnest(%(property_codes)s)'''
+
+every_property = '''
+                select distinct property_code from cascade_test
+                union all
+                select %(all_properties)s'''
 
-individual_prop_full_year = '''
-        select a.day, b.occupied
-          from (select cf1.day, rc1.month_no, rc1.week_no, rc1.day_no
+# Days of cascade_test to plot with their retail calendar coordinates
+property_test_days = '''
+                select distinct cf1.property_code, cf1.day, rc1.month_no, rc1.week_no, rc1.day_no
                   from cascade_test cf1,
                        retail_calendar rc1
                  where rc1.day = cf1.day
-                   and cf1.property_code = %s
-                   and cf1.day >= to_date(%s, 'YYYY-MM-DD')) a,
-               (select rc2.month_no, rc2.week_no, rc2.day_no, avg(cf2.occupied) as occupied
-                  from retail_calendar rc2,
-                       cascade_hist cf2
-                 where rc2.day = cf2.day
-                   and cf2.property_code = %s
-                   and cf2.day < to_date(%s, 'YYYY-MM-DD')
-                 group by rc2.month_no, rc2.week_no, rc2.day_no) b
-         where a.month_no = b.month_no
-           and a.week_no = b.week_no
-           and a.day_no = b.day_no
-           limit 366
-        ;'''
+                   and cf1.property_code in (select property_code from properties)
+                   and {test_filter}'''
 
-individual_prop_peak = '''
-        select a.day, b.occupied
-          from (select cf1.day, rc1.month_no, rc1.week_no, rc1.day_no
+# Same days for the whole fleet under 'All Properties'
+all_properties_test_days = '''
+                select distinct %(all_properties)s, cf1.day, rc1.month_no, rc1.week_no, rc1.day_no
                   from cascade_test cf1,
                        retail_calendar rc1
                  where rc1.day = cf1.day
-                   and cf1.property_code = %s
-                   and cf1.month between 6 and 10) a,
-               (select rc2.month_no, rc2.week_no, rc2.day_no, avg(cf2.occupied) as occupied
-                  from retail_calendar rc2,
-                       cascade_hist cf2
-                 where rc2.day = cf2.day
-                   and cf2.property_code = %s
-                   and cf2.day < to_date(%s, 'YYYY-MM-DD')
-                   and cf2.year = 2017
-                 group by rc2.month_no, rc2.week_no, rc2.day_no) b
-         where a.month_no = b.month_no
-           and a.week_no = b.week_no
-           and a.day_no = b.day_no
-           limit 366
+                   and {test_filter}'''
+
+historic_template = '''
+        with properties (property_code) as ({properties}),
+             test_days (property_code, day, month_no, week_no, day_no) as ({test_days}),
+             baseline as (
+                select cb.property_code, cb.month_no, cb.week_no, cb.day_no,
+                       cb.{baseline_sum} / cb.{baseline_count} as occupied
+                  from cascade_baseline cb
+                 where cb.property_code in (select property_code from properties)
+                   and cb.{baseline_count} > 0),
+             history_years as (
+                select cf.property_code, count(distinct(cf.year)) - 1 as num_years
+                  from cascade_full cf
+                 where cf.property_code in (select property_code from properties)
+                   and cf.day < to_date(%(start_date)s, 'YYYY-MM-DD')
+                 group by cf.property_code),
+             series as (
+                select a.property_code, a.day, b.occupied,
+                       row_number() over (partition by a.property_code order by a.day) as day_rank
+                  from test_days a,
+                       baseline b
+                 where a.property_code = b.property_code
+                   and a.month_no = b.month_no
+                   and a.week_no = b.week_no
+                   and a.day_no = b.day_no)
+        select p.property_code, s.day, s.occupied, y.num_years
+          from properties p
+               left join series s
+                 on s.property_code = p.property_code
+                and s.day_rank <= case when p.property_code = %(all_properties)s
+                                       then %(max_all_properties_days)s
+                                       else %(max_days)s end
+               left join history_years y
+                 on y.property_code = p.property_code
+         order by p.property_code, s.day
         ;'''
 
-all_properties_full_year = '''
-        select a.day, avg(b.occupied)
-          from (select cf1.day, rc1.month_no, rc1.week_no, rc1.day_no, count(*)
-                  from cascade_test cf1,
-                       retail_calendar rc1
-                 where rc1.day = cf1.day
-                   and cf1.day >= to_date(%s, 'YYYY-MM-DD')
-                 group by cf1.day, rc1.month_no, rc1.week_no, rc1.day_no) a,
-               (select rc2.month_no, rc2.week_no, rc2.day_no, avg(cf2.occupied) as occupied
-                  from retail_calendar rc2,
-                       cascade_hist cf2
-                 where rc2.day = cf2.day
-                   and cf2.day < to_date(%s, 'YYYY-MM-DD')
-                 group by rc2.month_no, rc2.week_no, rc2.day_no) b
-         where a.month_no = b.month_no
-           and a.week_no = b.week_no
-           and a.day_no = b.day_no
-         group by a.day
-         order by a.day
-         limit 365
-        '''
-
-all_properties_peak = '''
-        select a.day, b.occupied
-          from (select cf1.day, rc1.month_no, rc1.week_no, rc1.day_no, count(*)
-                  from cascade_test cf1,
-                       retail_calendar rc1
-                 where rc1.day = cf1.day
-                   and cf1.month between 6 and 10
-                 group by cf1.day, rc1.month_no, rc1.week_no, rc1.day_no) a,
-               (select rc2.month_no, rc2.week_no, rc2.day_no, avg(cf2.occupied) as occupied
-                  from retail_calendar rc2,
-                       cascade_hist cf2
-                 where rc2.day = cf2.day
-                   and cf2.day < to_date(%s, 'YYYY-MM-DD')
-                   and cf2.year = 2017
-                 group by rc2.month_no, rc2.week_no, rc2.day_no) b
-         where a.month_no = b.month_no
-           and a.week_no = b.week_no
-           and a.day_no = b.day_no
-           limit 366
-           '''
-
-def fetch_data_for_plotting(df, property_name, prob, start_date, full_year=True):
+def historic_query(property_names=None, start_date='2018-01-01', full_year=True):
+    '''
+    Inputs
+    property_names: list of property names, may include 'All Properties'.
+    None fetches every property in cascade_test and All Properties.
+    start_date: first day of the predictions as 'YYYY-MM-DD'. cascade_hist
+    ends before it, see cascade_baseline.py.
+    full_year: whether the series covers the full year from start_date or
+    only the peak months
+
+    Output: query and its parameters that return the historic series of all
+    the properties in one round trip, with property_code, day, occupied
+    and num_years columns. Properties without history come back as a single
+    row with a null day.
+    '''
+    if full_year:
+        test_filter = "cf1.day >= to_date(%(start_date)s, 'YYYY-MM-DD')"
+        baseline_sum, baseline_count = 'occupied_sum', 'day_count'
+    else:
+        test_filter = 'cf1.month = any(%(peak_months)s)'
+        baseline_sum, baseline_count = 'peak_sum', 'peak_count'
+
+    test_days = []
+    if property_names is None or any(name != all_properties for name in property_names):
+        test_days.append(property_test_days.format(test_filter=test_filter))
+    if property_names is None or all_properties in property_names:
+        test_days.append(all_properties_test_days.format(test_filter=test_filter))
+
+    query = historic_template.format(properties=every_property if property_names is None else listed_properties,
+                                     test_days='\n                union all'.join(test_days),
+                                     baseline_sum=baseline_sum, baseline_count=baseline_count)
+    params = {'property_codes': list(property_names or []),
+              'all_properties': all_properties,
+              'start_date': start_date,
+              'peak_months': peak_months,
+              'max_days': 366,
+              'max_all_properties_days': 365 if full_year else 366}
+
+    return query, params
+
+def fetch_historic(property_names=None, start_date='2018-01-01', full_year=True):
+    '''
+    Inputs: same as historic_query()
+
+    Output: dictionary keyed by property name of (historic_occupied,
+    num_years), where historic_occupied is a dataframe indexed by day with an
+    occupied column and num_years a tuple with the number of years of history.
+    For All Properties num_years defaults to 2 yrs. Peak series are divided
+    by peak_divisor.
+    '''
+    # Imported here so that plotting from an in memory baseline works without
+    # any database configuration, see cascade_memory_baseline.py
+    from cascade_db import connection
+
+    query, params = historic_query(property_names, start_date, full_year)
+
+    with connection() as conn:
+        historic = pd.read_sql_query(query, conn, params=params)
+
+    if not full_year:
+        historic.occupied = np.divide(historic.occupied, peak_divisor)
+
+    result = {}
+    for property_name, rows in historic.groupby('property_code', sort=False):
+        if property_name == all_properties:
+            num_years = (2,)
+        elif rows['num_years'].notnull().any():
+            num_years = (int(rows['num_years'].iloc[0]),)
+        else:
+            num_years = (-1,)
+
+        historic_occupied = rows[rows['day'].notnull()][['day', 'occupied']]
+        historic_occupied.index = pd.to_datetime(historic_occupied['day'])
+        historic_occupied = historic_occupied.drop('day', axis=1)
+
+        result[property_name] = (historic_occupied, num_years)
+
+    return result
+
+def build_prediction_store(df, prob):
+    '''
+    Inputs
+    df: data set the predictions were made on, with property_code, day and
+    month columns
+    prob: result of model.predict_proba on df
+
+    Output: dictionary built once per model/data load so that a prediction
+    series can be fetched without going through df again:
+    'full' and 'peak': predictions indexed by day with a prob column, stably
+    sorted by property_code (rows of a property stay in df order), for all
+    months and for the peak months
+    'full_offsets' and 'peak_offsets': (start, end) rows of every property
+    'full_fleet' and 'peak_fleet': daily mean prob of All Properties
+    '''
+    predictions = pd.DataFrame({'property_code': df['property_code'].values,
+                                'month': df['month'].values,
+                                'prob': prob[:,1]},
+                               index=pd.DatetimeIndex(pd.to_datetime(df['day'].values), name='day'))
+
+    store = {}
+    for mode, rows in [('full', predictions),
+                       ('peak', predictions[predictions.month.isin(peak_months)])]:
+        rows = rows.iloc[np.argsort(rows['property_code'].values, kind='mergesort')]
+        codes = rows['property_code'].values
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.array([], dtype=int)
+        ends = np.r_[starts[1:], len(codes)]
+
+        store[mode] = rows[['prob']]
+        store[mode + '_offsets'] = dict(zip(codes[starts], zip(starts, ends)))
+        store[mode + '_fleet'] = pd.DataFrame(rows.groupby(level='day').prob.mean())
+
+    return store
+
+def predicted_series(store, property_name, full_year=True):
+    '''
+    Output: prediction series of property_name from a store built by
+    build_prediction_store(), indexed by day with a prob column. Slices of a
+    property share memory with the store, don't modify them in place.
+    '''
+    mode = 'full' if full_year else 'peak'
+
+    if property_name == all_properties:
+        return store[mode + '_fleet']
+
+    start, end = store[mode + '_offsets'].get(property_name, (0, 0))
+    return store[mode].iloc[start:end]
+
+def fetch_data_for_plotting(df, property_name, prob, start_date, full_year=True, baseline=None, store=None):
     '''
     Inputs
     df: full data set that's reflective of data in cascade_full table.
@@ -120,6 +234,11 @@ def fetch_data_for_plotting(df, property_name, prob, start_date, full_year=True)
     retrieve historic data corresponding to the future year using retail calendar
     historic: indicates whether the historic information needs to be returned
     using database query/fetch
+    baseline: in memory baseline from cascade_memory_baseline.build_baseline().
+    When given, historic data is computed from it instead of the database.
+    store: prediction store from build_prediction_store(df, prob). Apps that
+    plot many properties should build it once and pass it in, otherwise it's
+    built on every call.
 
     Output
     y_series: To be used by timeseries plot (historic or actual)
@@ -128,84 +247,74 @@ def fetch_data_for_plotting(df, property_name, prob, start_date, full_year=True)
     is included in y_series. Also it defaults to 2 yrs when using All Properties
     option.
     '''
-    conn = psycopg2.connect(dbname=dbname,
-                            user=username, password=password,
-                            host=host,
-                            port=port)
-
-    num_years = 0
-    peak_divisor = 2.5
-
-    result_df = df.copy()
-    result_df = result_df[['property_code', 'day', 'month']]
-    result_df['prob'] = prob[:,1]
-
-    if property_name == 'All Properties':
-        if full_year:
-            historic_occupied = pd.read_sql_query(all_properties_full_year, conn,
-                                                  params=[start_date, start_date])
-            predicted_occupied = pd.DataFrame(result_df.groupby('day').prob.mean())
-        else:
-            historic_occupied = pd.read_sql_query(all_properties_peak, conn,
-                                                  params=[start_date])
-            historic_occupied.occupied = np.divide(historic_occupied.occupied, peak_divisor)
+    if store is None:
+        store = build_prediction_store(df, prob)
 
-            predicted_occupied = pd.DataFrame(result_df[(result_df.month.isin([6, 7, 8, 9, 10]))].groupby('day').prob.mean())
+    if baseline is None:
+        historic = fetch_historic([property_name], start_date, full_year)
+    else:
+        from cascade_memory_baseline import memory_historic
+        historic = memory_historic(baseline, df, [property_name], full_year)
 
+    historic_occupied, num_years = historic[property_name]
+    predicted_occupied = predicted_series(store, property_name, full_year)
 
-        predicted_occupied.index = pd.to_datetime(predicted_occupied.index)
+    return historic_occupied, predicted_occupied, num_years
 
-        num_years = (2,)
-    else:
-        if full_year:
-            historic_occupied = pd.read_sql_query(individual_prop_full_year, conn,
-                                                  params=[property_name, start_date, property_name, start_date])
+def invalidate_prop_list():
+    '''
+    Drops the cached property list so that the next web_prop_list() call
+    reloads it from the database.
+    '''
+    with prop_list_lock:
+        prop_list_cache['prop_list'] = None
 
-            predicted_occupied = result_df[result_df['property_code'] == property_name]
-        else:
-            historic_occupied = pd.read_sql_query(individual_prop_peak, conn,
-                                                  params=[property_name, property_name, start_date])
-            historic_occupied.occupied = np.divide(historic_occupied.occupied, peak_divisor)
+def web_prop_list(baseline=None):
+    '''
+    This function will return a list of properties that will be eligible for
+    getting its prediction. Note that adding 2 years worth of days + 2 to
+    account for leap year.
+
+    The list is cached, see prop_list_ttl. Concurrent callers wait for a
+    single reload instead of each running the query.
+
+    baseline: in memory baseline, see fetch_data_for_plotting()
+    '''
+    if baseline is not None:
+        from cascade_memory_baseline import memory_prop_list
+        return memory_prop_list(baseline)
+
+    from cascade_db import connection, last_refresh
 
-            predicted_occupied = result_df[(result_df.month.isin([6, 7, 8, 9, 10])) & (result_df.property_code==property_name)]
+    with prop_list_lock:
+        now = time.time()
+        cached = prop_list_cache['prop_list']
 
-        predicted_occupied.index = pd.to_datetime(predicted_occupied['day'])
-        predicted_occupied = predicted_occupied.drop(['day','property_code','month'], axis=1)
+        if cached is not None and now - prop_list_cache['loaded_at'] < prop_list_ttl:
+            if now - prop_list_cache['checked_at'] < prop_list_check:
+                return list(cached)
 
-        cur = conn.cursor()
-        num_years = '''
-                    select count(distinct(year)) - 1 as num_years
+            refreshed_at = last_refresh('cascade_full')
+            prop_list_cache['checked_at'] = now
+            if refreshed_at == prop_list_cache['refreshed_at']:
+                return list(cached)
+        else:
+            refreshed_at = last_refresh('cascade_full')
+
+        query = '''
+                    select property_code
                       from cascade_full
-                     where property_code = %s
-                       and day < to_date(%s, 'yyyy-mm-dd');
-                  '''
-        cur.execute(num_years, [property_name, start_date])
-        num_years = cur.fetchone()
+                     group by property_code
+                    having min(distinct(day)) + 732 < current_date
+                    order by 1
+                ;'''
 
-    historic_occupied.index = pd.to_datetime(historic_occupied['day'])
-    historic_occupied = historic_occupied.drop('day', axis=1)
+        with connection() as conn:
+            list_prop = pd.read_sql_query(query, conn)
 
-    return historic_occupied, predicted_occupied, num_years
+        prop_list_cache['prop_list'] = list(['All Properties']) + list(list_prop.property_code)
+        prop_list_cache['loaded_at'] = now
+        prop_list_cache['checked_at'] = now
+        prop_list_cache['refreshed_at'] = refreshed_at
 
-def web_prop_list():
-    '''
-    This function will return a list of properties that will be eligible for
-    getting its prediction. Note that adding 2 years worth of days + 2 to
-    account for leap year.
-    '''
-    conn = psycopg2.connect(dbname=dbname,
-                            user=username, password=password,
-                            host=host,
-                            port=port)
-
-    query = '''
-                select property_code
-                  from cascade_full
-                 group by property_code
-                having min(distinct(day)) + 732 < current_date
-                order by 1
-            ;'''
-
-    list_prop = pd.read_sql_query(query, conn)
-
-    return list(['All Properties']) + list(list_prop.property_code)
+        return list(prop_list_cache['prop_list'])
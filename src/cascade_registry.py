@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import glob
+import shutil
+import pickle
+import argparse
+import threading
+from datetime import datetime
+import joblib
+home_path = os.environ['CASCADE_HOME']
+sys.path.append(home_path + 'cascade/src')
+from cascade_model import save_vocabulary, load_vocabulary, engine_xy
+
+'''
+Versioned model registry. Every registered model gets its own directory
+
+    models/<name>/<version>/model.joblib     fitted model
+    models/<name>/<version>/vocabulary.pkl   feature vocabulary, when known
+    models/<name>/<version>/metadata.json    snapshot, metrics, ...
+
+Versions are numbered 0001, 0002, ... and are never modified once
+registered. Apps pick a model by name and 'latest' or a pinned version.
+
+Models are stored uncompressed with joblib and loaded with mmap_mode='r':
+the numpy arrays of the model (coefficients, HistGradientBoosting tree
+nodes, ...) are memory mapped from the file, so app processes on the same
+machine share one copy through the page cache. GradientBoostingClassifier
+trees copy their nodes when unpickled, those are loaded in memory.
+'''
+
+registry_path = home_path + 'models/'
+default_name = 'occupancy'
+
+# Models already loaded by this process, see get_model()
+loaded_models = {}
+loaded_lock = threading.Lock()
+
+def list_versions(name=default_name):
+    '''
+    Output: sorted list of the registered versions of a model
+    '''
+    paths = glob.glob(registry_path + name + '/[0-9]*')
+
+    return sorted(os.path.basename(path) for path in paths if '.tmp' not in path)
+
+def resolve_version(name=default_name, version='latest'):
+    '''
+    Output: version number of 'latest' or of the given version. Raises
+    ValueError when there isn't one.
+    '''
+    versions = list_versions(name)
+
+    if version == 'latest':
+        if not versions:
+            raise ValueError("No version of model {} is registered".format(name))
+        return versions[-1]
+
+    version = '{:04d}'.format(int(version))
+    if version not in versions:
+        raise ValueError("Model {} has no version {}".format(name, version))
+
+    return version
+
+def register_model(model, name=default_name, vocabulary=None, snapshot=None, metrics=None, **metadata):
+    '''
+    Inputs
+    model: fitted model
+    name: name of the model, e.g. 'occupancy'
+    vocabulary: vocabulary the model was trained with, see
+    cascade_model.fit_vocabulary()
+    snapshot: identifies the training data, e.g.
+    cascade_matrix_cache.data_digest() of cascade_full
+    metrics: dictionary of evaluation metrics, e.g. {'AUC_score': .81}
+    metadata: anything else to record, e.g. engine='gbc'
+
+    Output: the new version number
+    '''
+    model_path = registry_path + name + '/'
+    if not os.path.exists(model_path):
+        os.makedirs(model_path)
+
+    #written to a temporary directory first so that a partially written
+    #version is never picked up as 'latest'
+    tmp_path = model_path + 'new.tmp{}_{}/'.format(os.getpid(), threading.get_ident())
+    os.makedirs(tmp_path)
+
+    joblib.dump(model, tmp_path + 'model.joblib')
+    if vocabulary is not None:
+        save_vocabulary(vocabulary, tmp_path + 'vocabulary.pkl')
+
+    record = dict(metadata)
+    record.update({'name': name,
+                   'registered_at': datetime.now().isoformat(),
+                   'model_class': type(model).__name__,
+                   'snapshot': snapshot,
+                   'metrics': metrics or {},
+                   'num_features': len(vocabulary['feature_names']) if vocabulary is not None else None})
+
+    #another process may register the same version number first, then the
+    #rename fails and the next number is tried
+    while True:
+        versions = list_versions(name)
+        record['version'] = '{:04d}'.format(int(versions[-1]) + 1 if versions else 1)
+        with open(tmp_path + 'metadata.json', 'w') as f:
+            json.dump(record, f, indent=2, default=str)
+
+        try:
+            os.rename(tmp_path, model_path + record['version'])
+            break
+        except OSError:
+            if not os.path.exists(model_path + record['version']):
+                shutil.rmtree(tmp_path)
+                raise
+
+    print("Registered model {} version {}".format(name, record['version']))
+    return record['version']
+
+def load_model(name=default_name, version='latest'):
+    '''
+    Output: model, vocabulary (None when not registered) and metadata of a
+    registered version, loaded from disk
+    '''
+    version = resolve_version(name, version)
+    path = registry_path + name + '/' + version + '/'
+
+    model = joblib.load(path + 'model.joblib', mmap_mode='r')
+
+    vocabulary = None
+    if os.path.exists(path + 'vocabulary.pkl'):
+        vocabulary = load_vocabulary(path + 'vocabulary.pkl')
+
+    with open(path + 'metadata.json') as f:
+        metadata = json.load(f)
+
+    return model, vocabulary, metadata
+
+def load_metadata(name=default_name, version='latest'):
+    '''
+    Output: metadata of a registered version without loading the model
+    '''
+    version = resolve_version(name, version)
+
+    with open(registry_path + name + '/' + version + '/metadata.json') as f:
+        return json.load(f)
+
+def get_model(name=default_name, version='latest'):
+    '''
+    Same as load_model() but loaded once per process on first use and kept,
+    e.g. in the apps. 'latest' is resolved on that first use.
+    '''
+    with loaded_lock:
+        if (name, version) not in loaded_models:
+            loaded_models[(name, version)] = load_model(name, version)
+
+        return loaded_models[(name, version)]
+
+def predict_proba(df, name=default_name, version='latest'):
+    '''
+    Inputs
+    df: data to score, e.g. cascade_test
+    name, version: registered model, loaded with get_model()
+
+    Output: predict_proba of the model on df. df is encoded with the
+    registered vocabulary in the form of the model engine, so the feature
+    columns never depend on df. Raises ValueError for a model registered
+    without a vocabulary.
+    '''
+    model, vocabulary, metadata = get_model(name, version)
+
+    if vocabulary is None:
+        raise ValueError("Model {} version {} has no vocabulary, register it again with the "
+                         "vocabulary it was trained with (--vocabulary)"
+                         .format(name, metadata['version']))
+
+    X, y = engine_xy(df, vocabulary, metadata.get('engine', 'gbc'))
+
+    return model.predict_proba(X)
+
+def import_pickle(path, name=default_name, vocabulary=None, snapshot=None, metrics=None, **metadata):
+    '''
+    Registers a model saved with pickle before the registry existed, e.g.
+    import_pickle(home_path + 'GBC_model_1802.pkl')
+
+    Output: the new version number
+    '''
+    with open(path, 'rb') as f:
+        model = pickle.load(f)
+
+    if vocabulary is None:
+        print("Warning: {} is registered without a vocabulary, it can't be served".format(path))
+
+    metadata['source'] = os.path.basename(path)
+
+    return register_model(model, name, vocabulary, snapshot, metrics, **metadata)
+
+def main():
+    parser = argparse.ArgumentParser(description='Cascade model registry')
+    parser.add_argument('--name', default=default_name, help='model name')
+    parser.add_argument('--import-pickle', help='pickled model to register')
+    parser.add_argument('--vocabulary', help='pickled vocabulary of the imported model')
+    args = parser.parse_args()
+
+    if args.import_pickle:
+        vocabulary = load_vocabulary(args.vocabulary) if args.vocabulary else None
+        import_pickle(args.import_pickle, args.name, vocabulary)
+
+    for version in list_versions(args.name):
+        metadata = load_metadata(args.name, version)
+        print(version, metadata['registered_at'], metadata['model_class'],
+              metadata.get('source', ''), metadata['metrics'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import numpy as np
+import pandas as pd
+import os
+import sys
+import argparse
+home_path = os.environ['CASCADE_HOME']
+sys.path.append(home_path + 'cascade/src')
+
+'''
+4-5-4 retail calendar (aka NRF calendar) computed in process so that
+historic and future days can be lined up without joining to the
+retail_calendar table.
+
+A retail year starts on the Sunday closest to February 1st and ends on the
+Saturday closest to January 31st of the following calendar year. Its
+months are made of 4, 5 and 4 weeks per quarter; every 5 or 6 years the
+year has a 53rd week that belongs to the last month.
+
+Coordinates of a day
+retail_year: calendar year in which the retail year starts
+month_no: 1 (February) to 12 (January)
+week_no: week of the retail year, 1 to 53
+day_no: day of the week, 1 (Sunday) to 7 (Saturday)
+'''
+
+# Number of weeks in each retail month, February to January
+weeks_per_month = np.array([4, 5, 4, 4, 5, 4, 4, 5, 4, 4, 5, 4])
+month_end_week = np.cumsum(weeks_per_month)
+
+# Range of days covered by day_lookup
+lookup_start = np.datetime64('2000-01-01')
+lookup_end = np.datetime64('2050-12-31')
+
+def year_start(years):
+    '''
+    Input: array of calendar years
+    Output: datetime64[D] array with the first day of the retail year that
+    starts in each of the years: the Sunday closest to February 1st
+    '''
+    feb_first = (np.asarray(years) - 1970).astype('datetime64[Y]').astype('datetime64[D]') + 31
+    #1970-01-01 was a Thursday, this makes Sunday 0
+    weekday = (feb_first.astype(int) + 4) % 7
+    offset = np.where(weekday <= 3, -weekday, 7 - weekday)
+
+    return feb_first + offset
+
+def retail_coordinates(dates):
+    '''
+    Input: array like of dates
+    Output: retail_year, month_no, week_no and day_no as integer arrays
+
+    Computed directly from the dates. See lookup_coordinates() for the faster
+    version backed by day_lookup.
+    '''
+    days = np.asarray(dates, dtype='datetime64[D]')
+    years = days.astype('datetime64[Y]').astype(int) + 1970
+
+    #days in January before the start of the retail year belong to the
+    #retail year that started the calendar year before
+    start = year_start(years)
+    before = days < start
+    retail_year = np.where(before, years - 1, years)
+    start = np.where(before, year_start(years - 1), start)
+
+    day_of_year = (days - start).astype(int)
+    week_index = day_of_year // 7
+
+    #53rd week belongs to the last month
+    month_no = np.minimum(np.searchsorted(month_end_week, week_index, side='right') + 1, 12)
+    week_no = week_index + 1
+    day_no = day_of_year % 7 + 1
+
+    return retail_year, month_no, week_no, day_no
+
+# Precomputed coordinates for every day between lookup_start and lookup_end,
+# indexed by day ordinal (days since lookup_start). One row per day with
+# retail_year, month_no, week_no and day_no columns.
+day_lookup = np.stack(retail_coordinates(np.arange(lookup_start, lookup_end + 1)), axis=1).astype(np.int16)
+
+def lookup_coordinates(dates):
+    '''
+    Input: array like of dates
+    Output: integer array with one row per date and retail_year, month_no,
+    week_no and day_no columns
+
+    Dates between lookup_start and lookup_end are read from day_lookup, any
+    other date is computed with retail_coordinates().
+    '''
+    days = np.asarray(dates, dtype='datetime64[D]')
+    ordinal = (days - lookup_start).astype(int)
+    in_lookup = (days >= lookup_start) & (days <= lookup_end)
+
+    if in_lookup.all():
+        return day_lookup[ordinal]
+
+    coordinates = np.empty((len(days), 4), dtype=np.int16)
+    coordinates[in_lookup] = day_lookup[ordinal[in_lookup]]
+    coordinates[~in_lookup] = np.stack(retail_coordinates(days[~in_lookup]), axis=1)
+
+    return coordinates
+
+def add_retail_calendar(df, date_column='day'):
+    '''
+    Input
+    df: dataframe with a date column
+    date_column: name of the date column
+
+    Output: df with retail_year, month_no, week_no and day_no columns added
+    '''
+    dates = pd.to_datetime(df[date_column]).values
+    coordinates = lookup_coordinates(dates)
+
+    for i, column in enumerate(['retail_year', 'month_no', 'week_no', 'day_no']):
+        df[column] = coordinates[:, i]
+
+    return df
+
+def retail_calendar_table(start='2010-01-01', end='2030-12-31'):
+    '''
+    Output: dataframe with one row per day between start and end (inclusive)
+    and its retail calendar coordinates, in the shape of the retail_calendar
+    table.
+    '''
+    df = pd.DataFrame()
+    df['day'] = pd.date_range(start, end, freq='D')
+
+    return add_retail_calendar(df)
+
+# Table main() loads the generated calendar into. Its day column is a
+# timestamp and it has a retail_year column, which the retail_calendar table
+# the plot queries and cascade_baseline join on may not have.
+generated_table = 'retail_calendar_generated'
+
+def table_columns(cursor, table_name):
+    '''
+    Output: list of (column name, data type) of a table, in column order
+    '''
+    cursor.execute('''
+                   select column_name, data_type
+                     from information_schema.columns
+                    where table_schema = current_schema()
+                      and table_name = %s
+                    order by ordinal_position
+                   ;''', (table_name,))
+
+    return cursor.fetchall()
+
+def main(replace=False):
+    '''
+    Loads the generated calendar into generated_table, leaving the
+    retail_calendar table as it is.
+
+    replace: also replace the rows of retail_calendar with the generated
+    ones, in one transaction. Only done when retail_calendar has the same
+    columns and types as generated_table, ValueError is raised otherwise.
+    The table itself is kept, so views and indexes on it are too.
+    '''
+    # Imported here so that the calendar itself can be used without any
+    # database configuration
+    from cascade_sql import write_to_table
+    from cascade_db import get_engine, connection, record_refresh
+
+    write_to_table(retail_calendar_table(), get_engine(), generated_table, if_exists='replace')
+    print("Generated calendar loaded into {}".format(generated_table))
+
+    if not replace:
+        return
+
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            existing = table_columns(cursor, 'retail_calendar')
+            generated = table_columns(cursor, generated_table)
+            if existing != generated:
+                raise ValueError("retail_calendar columns {} don't match the generated {}, "
+                                 "not replaced".format(existing, generated))
+
+            cursor.execute('delete from retail_calendar')
+            cursor.execute('insert into retail_calendar select * from {}'.format(generated_table))
+
+    record_refresh('retail_calendar')
+    print("retail_calendar replaced")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Loads the generated 4-5-4 retail calendar')
+    parser.add_argument('--replace', action='store_true',
+                        help='replace the rows of retail_calendar when its columns match')
+    args = parser.parse_args()
+
+    main(args.replace)
@@ -1,7 +1,22 @@
 import pandas as pd
+import numpy as np
 import io
+import itertools
+import os
+from collections import deque
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from sqlalchemy import create_engine
 
+# Binary COPY format constants, see
+# https://www.postgresql.org/docs/current/static/sql-copy.html
+copy_binary_header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+copy_binary_trailer = struct.pack('>h', -1)
+copy_binary_null = struct.pack('>i', -1)
+# Postgres timestamps are microseconds since 2000-01-01
+postgres_epoch = np.datetime64('2000-01-01T00:00:00', 'us')
+
 def write_to_table(df, db_engine, table_name, if_exists='fail'):
     '''
     Using code from user mgoldwasser's responde to the question on stackoverflow
@@ -33,3 +48,605 @@ def write_to_table(df, db_engine, table_name, if_exists='fail'):
             copy_cmd = "COPY %s FROM STDIN HEADER DELIMITER '|' CSV" % table_name
             cursor.copy_expert(copy_cmd, string_data_io)
         connection.connection.commit()
+
+class IterableFile(io.RawIOBase):
+    '''
+    Read only file-like object over an iterable of bytes chunks. copy_expert
+    pulls the data through read() so chunks are only generated as Postgres
+    consumes them.
+    '''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.buffer) == 0:
+            try:
+                self.buffer = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+
+        return size
+
+def csv_chunks(df, chunksize):
+    '''
+    Generates df as '|' delimited csv, chunksize rows at a time, without header.
+    '''
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start:start + chunksize].to_csv(sep='|', index=False, header=False).encode('utf-8')
+
+def fixed_width_values(series):
+    '''
+    Input: pandas series
+    Output: values and big-endian numpy format of the series in binary COPY
+    format, or None for text series
+
+    Types follow the columns that pandas to_sql creates for the series: bool
+    as boolean, int8, uint8 and int16 as smallint, uint16 and int32 as
+    integer, other ints as bigint, float32 as real, float64 as double
+    precision, datetime64 as timestamp and strings as text. uint64 has no
+    column type and raises ValueError, as in to_sql.
+    '''
+    dtype = series.dtype
+
+    if pd.api.types.is_bool_dtype(dtype):
+        return series.values, '?'
+    elif pd.api.types.is_integer_dtype(dtype):
+        name = dtype.name.lower()
+        if name in ('int8', 'uint8', 'int16'):
+            return series.values, '>i2'
+        elif name in ('uint16', 'int32'):
+            return series.values, '>i4'
+        elif name == 'uint64':
+            raise ValueError("Column {} of type uint64 has no Postgres type".format(series.name))
+        return series.values, '>i8'
+    elif pd.api.types.is_float_dtype(dtype):
+        return series.values, '>f4' if dtype == np.float32 else '>f8'
+    elif pd.api.types.is_datetime64_any_dtype(dtype):
+        if getattr(dtype, 'tz', None) is not None:
+            series = series.dt.tz_convert('UTC').dt.tz_localize(None)
+        return (series.values.astype('datetime64[us]') - postgres_epoch).astype(np.int64), '>i8'
+    elif pd.api.types.infer_dtype(series, skipna=True) in ('string', 'empty'):
+        return None
+
+    raise ValueError("Column {} of type {} can't be written in binary COPY format, "
+                     "use binary=False".format(series.name, dtype))
+
+def pack_fixed_width(columns):
+    '''
+    Input: list of (values, format) of fixed width columns without nulls
+    Output: list with the binary COPY fields (length followed by value) of all
+    the columns, one bytes object per row
+
+    The fields of all the columns are built at once in a numpy structured
+    array and the resulting bytes are split per row.
+    '''
+    field_type = np.dtype([(name, field_format) for i, (values, value_format) in enumerate(columns)
+                           for name, field_format in (('length{}'.format(i), '>i4'),
+                                                      ('value{}'.format(i), value_format))])
+    packed = np.empty(len(columns[0][0]), dtype=field_type)
+    for i, (values, value_format) in enumerate(columns):
+        packed['length{}'.format(i)] = np.dtype(value_format).itemsize
+        packed['value{}'.format(i)] = values
+
+    raw = packed.tobytes()
+    width = field_type.itemsize
+
+    return [raw[i:i + width] for i in range(0, len(raw), width)]
+
+def binary_fields(series):
+    '''
+    Input: pandas series
+    Output: list with the binary COPY field (length followed by value) of
+    every value in the series. NaN, NaT and None are written as NULL.
+    '''
+    null = pd.isnull(series).values
+    fixed_width = fixed_width_values(series)
+
+    if fixed_width is None:
+        #text: every distinct value is only encoded once
+        codes, uniques = pd.factorize(series)
+        encoded = [u.encode('utf-8') for u in uniques]
+        encoded = [struct.pack('>i', len(e)) + e for e in encoded] + [copy_binary_null]
+        #code -1 (null) picks the last entry
+        return np.array(encoded, dtype=object)[codes].tolist()
+
+    fields = pack_fixed_width([fixed_width])
+    for i in np.flatnonzero(null):
+        fields[i] = copy_binary_null
+
+    return fields
+
+def binary_chunks(df, chunksize):
+    '''
+    Generates df in Postgres binary COPY format, chunksize rows at a time.
+
+    Consecutive fixed width columns without nulls are packed together by
+    pack_fixed_width(), other columns one at a time by binary_fields().
+    '''
+    yield copy_binary_header
+
+    num_fields = struct.pack('>h', len(df.columns))
+    for start in range(0, len(df), chunksize):
+        chunk = df.iloc[start:start + chunksize]
+
+        segments = []
+        fixed_width_group = []
+        for column in chunk.columns:
+            series = chunk[column]
+            fixed_width = fixed_width_values(series)
+            if fixed_width is not None and not pd.isnull(series).any():
+                fixed_width_group.append(fixed_width)
+                continue
+
+            if fixed_width_group:
+                segments.append(pack_fixed_width(fixed_width_group))
+                fixed_width_group = []
+            segments.append(binary_fields(series))
+
+        if fixed_width_group:
+            segments.append(pack_fixed_width(fixed_width_group))
+
+        rows = zip(itertools.repeat(num_fields, len(chunk)), *segments)
+        yield b''.join(itertools.chain.from_iterable(rows))
+
+    yield copy_binary_trailer
+
+def quote_identifier(name):
+    '''
+    Output: name quoted as a Postgres identifier
+    '''
+    return '"{}"'.format(name.replace('"', '""'))
+
+def copy_frame(cursor, df, table_name, chunksize=50000, binary=False):
+    '''
+    Streams df into an existing table with COPY on the given psycopg2 cursor.
+    Committing is left to the caller.
+
+    Inputs
+    cursor: psycopg2 cursor
+    df: dataframe to copy, its column names must match the table's
+    table_name: name of the table
+    chunksize: number of rows encoded at a time
+    binary: use the binary COPY format instead of csv. Column types of the
+    table must match the ones described in binary_fields().
+    '''
+    if binary:
+        chunks = binary_chunks(df, chunksize)
+    else:
+        chunks = csv_chunks(df, chunksize)
+
+    copy_chunks(cursor, chunks, table_name, df.columns, binary)
+
+def copy_chunks(cursor, chunks, table_name, columns, binary=False):
+    '''
+    Streams already encoded chunks into an existing table with COPY, see
+    copy_frame(). In binary format the chunks include the header and the
+    trailer.
+    '''
+    columns = ', '.join(quote_identifier(c) for c in columns)
+    if binary:
+        copy_format = 'FORMAT binary'
+    else:
+        copy_format = "FORMAT csv, DELIMITER '|'"
+
+    copy_cmd = 'COPY {} ({}) FROM STDIN WITH ({})'.format(table_name, columns, copy_format)
+    cursor.copy_expert(copy_cmd, IterableFile(chunks), size=2**16)
+
+def encode_chunk(args):
+    '''
+    Input: (df, binary) tuple
+    Output: df encoded as one chunk of csv_chunks() or binary_chunks(),
+    without the binary header and trailer. Runs in the encoding processes of
+    bulk_load().
+    '''
+    df, binary = args
+    if binary:
+        return b''.join(binary_chunks(df, max(len(df), 1)))[len(copy_binary_header):-len(copy_binary_trailer)]
+
+    return b''.join(csv_chunks(df, max(len(df), 1)))
+
+def encoded_chunks(encoder_pool, df, rows, chunksize, binary, window):
+    '''
+    Generates the rows of df encoded by encode_chunk() in encoder_pool,
+    chunksize rows at a time and in order. At most window chunks are
+    submitted ahead of the one being consumed, so memory stays bounded by
+    the window and not by the number of rows.
+    '''
+    pending = deque()
+    for start in range(0, len(rows), chunksize):
+        pending.append(encoder_pool.submit(encode_chunk, (df.iloc[rows[start:start + chunksize]], binary)))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+def swap_table(cursor, load_name, table_name):
+    '''
+    Replaces table_name with the table load_name on the given cursor. The
+    indexes of the old table are recreated on the new one, primary keys and
+    unique constraints as unique indexes. Committing is left to the caller.
+    '''
+    cursor.execute('''
+                   select indexdef
+                     from pg_indexes
+                    where schemaname = current_schema()
+                      and tablename = %s
+                   ;''', (table_name,))
+    indexes = [row[0] for row in cursor.fetchall()]
+
+    cursor.execute('drop table if exists {}'.format(table_name))
+    cursor.execute('alter table {} rename to {}'.format(load_name, table_name))
+    for index in indexes:
+        cursor.execute(index)
+
+def dependent_views(cursor, table_name):
+    '''
+    Output: list of the views that depend on table_name. Such a table can't
+    be dropped and swapped for a freshly loaded one without dropping them.
+    '''
+    cursor.execute('''
+                   select distinct v.oid::regclass::text
+                     from pg_depend d
+                     join pg_rewrite r on r.oid = d.objid
+                     join pg_class v on v.oid = r.ev_class
+                    where d.refobjid = to_regclass(%s)
+                      and v.oid <> d.refobjid
+                   ;''', (table_name,))
+
+    return [row[0] for row in cursor.fetchall()]
+
+def check_swappable(db_engine, table_name):
+    '''
+    Raises ValueError when views depend on table_name, before anything is
+    loaded, see bulk_load() and write_partitions().
+    '''
+    with db_engine.connect() as connection:
+        with connection.connection.cursor() as cursor:
+            views = dependent_views(cursor, table_name)
+
+    if views:
+        raise ValueError("Can't replace {}, views depend on it: {}. Drop them first and "
+                         "recreate them after the load.".format(table_name, ', '.join(views)))
+
+def copy_to_table(df, db_engine, table_name, if_exists='fail', chunksize=50000, binary=False, key=None,
+                  scope=None):
+    '''
+    Same as write_to_table() but the rows are streamed to COPY chunksize rows
+    at a time instead of rendering the whole dataframe into one csv string
+    first. The table is created with pandas public to_sql API.
+
+    Inputs
+    df: input datafram to create/insert/append to the DataBase
+    db_engine: instance of sqlalchemy that contains connect information to the
+    database
+    table_name: name of table that will be based on the passed in df
+    if_exists: 'fail', 'append' or 'replace' as in write_to_table(), or
+    'upsert' to merge df into the table on key (see upsert_table)
+    chunksize: number of rows encoded at a time
+    binary: use the binary COPY format, which skips formatting and parsing
+    values as text
+    key: list of columns that identify a row, required for 'upsert'
+    scope: for 'upsert', see upsert_table()
+    '''
+    if if_exists == 'upsert':
+        return upsert_table(df, db_engine, table_name, key, chunksize, binary, scope)
+
+    df.head(0).to_sql(table_name, db_engine, if_exists=if_exists, index=False)
+
+    with db_engine.connect() as connection:
+        with connection.connection.cursor() as cursor:
+            copy_frame(cursor, df, table_name, chunksize, binary)
+        connection.connection.commit()
+
+def upsert_table(df, db_engine, table_name, key, chunksize=50000, binary=False, scope=None):
+    '''
+    Merges df into table_name on the key columns in one transaction:
+    1. df is copied into a temporary staging table shaped like the table
+    2. rows of the table whose key is in df and whose values differ are updated
+    3. rows of df whose key is not in the table are inserted
+    4. rows of the table in the refreshed scope whose key is not in df are
+    deleted
+    Readers see either the table before or after the merge, never a partial
+    one.
+
+    The table is created from df when it doesn't exist yet, and an index on
+    the key columns is created if missing. key is expected to be unique in df.
+
+    Inputs
+    df: dataframe to merge
+    db_engine: instance of sqlalchemy that contains connect information to the
+    database
+    table_name: name of the table to merge into
+    key: list of columns that identify a row, e.g. ['property_code', 'day']
+    chunksize, binary: as in copy_to_table()
+    scope: list of columns that delimit the rows df refreshes, e.g.
+    ['property_code'] when df holds every row of some properties. Only rows
+    of the table whose scope values appear in df are deleted. None when df
+    holds the whole table.
+
+    Output: number of rows updated, inserted and deleted
+    '''
+    if not key:
+        raise ValueError("upsert into {} needs key columns".format(table_name))
+
+    df.head(0).to_sql(table_name, db_engine, if_exists='append', index=False)
+
+    staging_name = table_name + '_staging'
+    columns = [quote_identifier(c) for c in df.columns]
+    key_columns = [quote_identifier(c) for c in key]
+    value_columns = [quote_identifier(c) for c in df.columns if c not in key]
+    key_match = ' and '.join('t.{0} = s.{0}'.format(c) for c in key_columns)
+
+    with db_engine.connect() as connection:
+        with connection.connection.cursor() as cursor:
+            cursor.execute('create index if not exists {} on {} ({})'
+                           .format(quote_identifier(table_name + '_upsert_key'), table_name,
+                                   ', '.join(key_columns)))
+            cursor.execute('create temporary table {} (like {} including defaults) on commit drop'
+                           .format(staging_name, table_name))
+            copy_frame(cursor, df, staging_name, chunksize, binary)
+
+            num_updated = 0
+            if value_columns:
+                cursor.execute('''
+                               update {table} t
+                                  set {assignments}
+                                 from {staging} s
+                                where {key_match}
+                                  and ({target_values}) is distinct from ({staging_values})
+                               '''.format(table=table_name, staging=staging_name, key_match=key_match,
+                                          assignments=', '.join('{0} = s.{0}'.format(c) for c in value_columns),
+                                          target_values=', '.join('t.' + c for c in value_columns),
+                                          staging_values=', '.join('s.' + c for c in value_columns)))
+                num_updated = cursor.rowcount
+
+            cursor.execute('''
+                           insert into {table} ({columns})
+                           select {staging_columns}
+                             from {staging} s
+                            where not exists (select 1 from {table} t where {key_match})
+                           '''.format(table=table_name, staging=staging_name, key_match=key_match,
+                                      columns=', '.join(columns),
+                                      staging_columns=', '.join('s.' + c for c in columns)))
+            num_inserted = cursor.rowcount
+
+            in_scope = ''
+            if scope is not None:
+                scope_match = ' and '.join('t.{0} = s.{0}'.format(quote_identifier(c)) for c in scope)
+                in_scope = 'and exists (select 1 from {} s where {})'.format(staging_name, scope_match)
+            cursor.execute('''
+                           delete from {table} t
+                            where not exists (select 1 from {staging} s where {key_match})
+                              {in_scope}
+                           '''.format(table=table_name, staging=staging_name, key_match=key_match,
+                                      in_scope=in_scope))
+            num_deleted = cursor.rowcount
+        connection.connection.commit()
+
+    print("Upsert into {}: {} rows updated, {} rows inserted, {} rows deleted"
+          .format(table_name, num_updated, num_inserted, num_deleted))
+
+    return num_updated, num_inserted, num_deleted
+
+def split_partitions(df, partition_column, num_streams):
+    '''
+    Input
+    df: dataframe to split
+    partition_column: column whose values are kept together, e.g. year
+    num_streams: number of groups to split into
+
+    Output: list of up to num_streams arrays of row positions. Values of
+    partition_column are assigned largest first to the group with the fewest
+    rows so that groups end up with similar number of rows.
+    '''
+    counts = df[partition_column].value_counts()
+    group_rows = [0] * num_streams
+    group_values = [[] for i in range(num_streams)]
+    for value, count in counts.items():
+        smallest = group_rows.index(min(group_rows))
+        group_rows[smallest] += count
+        group_values[smallest].append(value)
+
+    return [np.flatnonzero(df[partition_column].isin(v).values) for v in group_values if v]
+
+def bulk_load(df, db_engine, table_name, partition_column='year', num_streams=4,
+              chunksize=50000, binary=False, encoders=None):
+    '''
+    Replaces table_name with the content of df using several COPY streams
+    in parallel:
+    1. an unlogged table named table_name + '_load' is created from df
+    2. df is split by partition_column into num_streams parts of similar size
+    and every part is copied over its own connection at the same time. The
+    chunks are encoded to csv or binary in a pool of encoders processes, the
+    encoding is Python work that threads can't run in parallel.
+    3. the loaded table is made logged, then in one transaction the old table
+    is dropped, the loaded one renamed to table_name and the indexes of the
+    old table rebuilt on it (see swap_table)
+
+    Readers keep seeing the old table until the swap, and wait for the index
+    builds during it. No view may depend on table_name, it couldn't be
+    dropped: ValueError is raised before loading anything when one does.
+    Every stream keeps at most 2 * encoders / num_streams encoded chunks
+    ahead of its COPY, so memory doesn't grow with the size of df.
+
+    Inputs
+    df: dataframe to load
+    db_engine: instance of sqlalchemy that contains connect information to the
+    database. Its pool needs at least num_streams connections.
+    table_name: name of table to replace
+    partition_column: column used to split df, e.g. year or property_code
+    num_streams: number of parallel COPY streams
+    chunksize, binary: as in copy_to_table()
+    encoders: number of encoding processes, defaults to the number of cpus
+
+    Output: dataframe with rows, seconds and rows per second of every stream
+    '''
+    check_swappable(db_engine, table_name)
+
+    if encoders is None:
+        encoders = os.cpu_count()
+
+    load_name = table_name + '_load'
+    df.head(0).to_sql(load_name, db_engine, if_exists='replace', index=False)
+
+    with db_engine.connect() as connection:
+        with connection.connection.cursor() as cursor:
+            cursor.execute('alter table {} set unlogged'.format(load_name))
+        connection.connection.commit()
+
+    def load_stream(rows):
+        start = time.time()
+        chunks = encoded_chunks(encoder_pool, df, rows, chunksize, binary, window)
+        if binary:
+            chunks = itertools.chain([copy_binary_header], chunks, [copy_binary_trailer])
+
+        with db_engine.connect() as connection:
+            with connection.connection.cursor() as cursor:
+                copy_chunks(cursor, chunks, load_name, df.columns, binary)
+            connection.connection.commit()
+
+        return len(rows), time.time() - start
+
+    partitions = split_partitions(df, partition_column, num_streams)
+    window = max(2 * encoders // max(len(partitions), 1), 1)
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=encoders) as encoder_pool:
+        with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+            results = list(executor.map(load_stream, partitions))
+    seconds = time.time() - start
+
+    stats = pd.DataFrame.from_records(results, columns=['rows', 'seconds'])
+    stats['rows_per_second'] = stats['rows'] / stats['seconds']
+    for stream in stats.itertuples():
+        print("Stream {}: {} rows in {:.2f}s, {:.0f} rows/s".format(stream.Index, stream.rows,
+                                                                    stream.seconds, stream.rows_per_second))
+    print("{} rows loaded into {} in {:.2f}s, {:.0f} rows/s".format(len(df), load_name, seconds,
+                                                                  len(df) / seconds))
+
+    with db_engine.connect() as connection:
+        with connection.connection.cursor() as cursor:
+            cursor.execute('alter table {} set logged'.format(load_name))
+            swap_table(cursor, load_name, table_name)
+        connection.connection.commit()
+
+    return stats
+
+def write_partitions(partitions, db_engine, table_name, if_exists='replace'):
+    '''
+    Writes every dataframe yielded by partitions to table_name as soon as it
+    is produced, so only one partition needs to be held in memory.
+
+    The partitions are loaded into a table named table_name + '_load' first.
+    Once all of them are loaded, in one transaction the loaded table replaces
+    table_name ('replace'), is renamed to it ('fail') or its rows are
+    inserted into it ('append'). Readers keep seeing the old table until then,
+    and a partition that fails to load leaves table_name untouched. With
+    'replace' no view may depend on table_name and its indexes are rebuilt,
+    see bulk_load().
+
+    Inputs
+    partitions: iterable of dataframes with the same columns
+    db_engine: instance of sqlalchemy that contains connect information to the
+    database
+    table_name: name of table that will be based on the first partition
+    if_exists: 'fail', 'append' or 'replace' as in write_to_table()
+
+    Output: number of rows written
+    '''
+    if if_exists == 'replace':
+        check_swappable(db_engine, table_name)
+
+    load_name = table_name + '_load'
+    columns = None
+    num_rows = 0
+    for i, df in enumerate(partitions):
+        write_to_table(df, db_engine, load_name, 'replace' if i == 0 else 'append')
+        if columns is None:
+            columns = ', '.join(quote_identifier(c) for c in df.columns)
+        num_rows += len(df)
+        print("Partition {}: {} rows written to {}".format(i, len(df), load_name))
+
+    if columns is None:
+        return num_rows
+
+    with db_engine.connect() as connection:
+        with connection.connection.cursor() as cursor:
+            if if_exists == 'append':
+                cursor.execute('insert into {0} ({1}) select {1} from {2}'
+                               .format(table_name, columns, load_name))
+                cursor.execute('drop table {}'.format(load_name))
+            elif if_exists == 'replace':
+                swap_table(cursor, load_name, table_name)
+            else:
+                cursor.execute('alter table {} rename to {}'.format(load_name, table_name))
+        connection.connection.commit()
+    print("{} rows written to {}".format(num_rows, table_name))
+
+    return num_rows
+
+def replace_ranges(df, db_engine, table_name, ranges, key='property_code', day='day'):
+    '''
+    Replaces the rows of an existing table that fall in date ranges with df,
+    in one transaction so that readers never see the rows missing.
+
+    The ranges are copied into a temporary table and the old rows removed by
+    a single delete joined against it. An index on (key, day) is created if
+    missing, so the delete only visits the rows it removes.
+
+    Inputs
+    df: dataframe with the new rows, its column names must match the table's
+    db_engine: instance of sqlalchemy that contains connect information to the
+    database
+    table_name: name of existing table to update
+    ranges: dataframe with key, start and end columns. Rows whose day is
+    between start and end, inclusive, of a range of their key are replaced.
+    key, day: columns of the table the ranges apply to
+
+    Output: number of rows deleted and inserted
+    '''
+    ranges_name = table_name + '_ranges'
+    ranges = pd.DataFrame({'range_key': ranges[key].values,
+                           'range_start': pd.to_datetime(ranges['start']).values,
+                           'range_end': pd.to_datetime(ranges['end']).values})
+
+    with db_engine.connect() as connection:
+        with connection.connection.cursor() as cursor:
+            cursor.execute('create index if not exists {} on {} ({}, {})'
+                           .format(quote_identifier(table_name + '_{}_{}'.format(key, day)), table_name,
+                                   quote_identifier(key), quote_identifier(day)))
+            cursor.execute('''
+                           create temporary table {} (
+                               range_key text,
+                               range_start timestamp,
+                               range_end timestamp
+                           ) on commit drop
+                           '''.format(ranges_name))
+            copy_frame(cursor, ranges, ranges_name)
+            cursor.execute('analyze {}'.format(ranges_name))
+
+            cursor.execute('''
+                           delete from {table} t
+                            using {ranges} r
+                            where t.{key} = r.range_key
+                              and t.{day} between r.range_start and r.range_end
+                           '''.format(table=table_name, ranges=ranges_name,
+                                      key=quote_identifier(key), day=quote_identifier(day)))
+            num_deleted = cursor.rowcount
+
+            if len(df) > 0:
+                copy_frame(cursor, df, table_name)
+        connection.connection.commit()
+
+    print("{}: {} rows deleted, {} rows inserted in {} ranges".format(table_name, num_deleted,
+                                                                      len(df), len(ranges)))
+
+    return num_deleted, len(df)
@@ -0,0 +1,169 @@
+import numpy as np
+import pandas as pd
+import os
+import sys
+import time
+import argparse
+import pickle
+from sklearn.linear_model import SGDClassifier
+from sklearn.metrics import log_loss, roc_auc_score
+home_path = os.environ['CASCADE_HOME']
+sys.path.append(home_path + 'cascade/src')
+from cascade_model import make_vocabulary, encode_xy, save_vocabulary, default_features
+from cascade_db import connection
+
+'''
+Out of core training: cascade_full is read through a server side cursor
+chunksize rows at a time, every chunk is encoded with a vocabulary fixed up
+front and fed to a model that supports partial_fit (logistic regression
+trained by SGD by default). Only one chunk is ever in memory, so peak
+memory depends on chunksize, not on the number of years of history.
+'''
+
+stream_model_path = home_path + 'LR_stream_model.pkl'
+stream_vocabulary_path = home_path + 'LR_stream_vocabulary.pkl'
+
+def query_vocabulary(columns=[], dummy=[], table_name='cascade_full', where='', params=None):
+    '''
+    Inputs
+    columns, dummy: same as make_xy()
+    table_name: table to read the categories from
+    where: optional filter, e.g. 'where year < %(test_year)s', so that the
+    vocabulary only has categories seen in training
+    params: parameters of the filter
+
+    Output: same vocabulary as fit_vocabulary() over the whole table, built
+    from one select distinct per dummy feature instead of loading the table
+    '''
+    columns, dummy = default_features(columns, dummy)
+
+    categories = {}
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            for column in dummy:
+                cursor.execute('''
+                               select distinct {column}
+                                 from {table_name}
+                                 {where} {conjunction} {column} is not null
+                               ;'''.format(column=column, table_name=table_name, where=where,
+                                           conjunction='and' if where else 'where'),
+                               params)
+                categories[column] = [row[0] for row in cursor.fetchall()]
+
+    return make_vocabulary(columns, dummy, categories)
+
+def stream_chunks(query, params=None, chunksize=50000):
+    '''
+    Inputs
+    query: select to stream
+    params: parameters of the query
+    chunksize: rows fetched from the server at a time
+
+    Output: generator of dataframes of at most chunksize rows. The rows are
+    kept on the server by a named (server side) cursor until fetched.
+    '''
+    with connection() as conn:
+        with conn.cursor(name='cascade_stream') as cursor:
+            cursor.itersize = chunksize
+            cursor.execute(query, params)
+
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows:
+                    break
+                columns = [column[0] for column in cursor.description]
+                yield pd.DataFrame.from_records(rows, columns=columns)
+
+def stream_query(vocabulary, where=''):
+    '''
+    Output: select of the vocabulary features and occupied from cascade_full
+    '''
+    return '''
+           select {}, occupied
+             from cascade_full
+             {}
+           ;'''.format(', '.join(vocabulary['columns']), where)
+
+def stream_train(vocabulary, model=None, where='', params=None, chunksize=50000, epochs=1, seed=127):
+    '''
+    Inputs
+    vocabulary: fixed vocabulary, e.g. from query_vocabulary()
+    model: model with partial_fit. Defaults to logistic regression trained
+    by SGD
+    where, params: filter of the training rows, e.g. 'where year < %(test_year)s'
+    chunksize: rows encoded and fitted at a time
+    epochs: passes over the training rows
+    seed: random seed of the shuffles
+
+    Rows come in table order, mostly grouped by property and date, so every
+    chunk is shuffled before partial_fit.
+
+    Output: fitted model
+    '''
+    if model is None:
+        #the default 'optimal' learning rate gives overconfident probabilities
+        #on the unscaled rating columns, a small adaptive rate doesn't
+        model = SGDClassifier(loss='log_loss', alpha=1e-4, learning_rate='adaptive',
+                              eta0=.01, random_state=seed)
+
+    rng = np.random.RandomState(seed)
+    query = stream_query(vocabulary, where)
+
+    for epoch in range(epochs):
+        start = time.time()
+        num_rows = 0
+
+        for chunk in stream_chunks(query, params, chunksize):
+            X, y = encode_xy(chunk, vocabulary)
+            order = rng.permutation(len(chunk))
+            model.partial_fit(X[order], y.values[order].astype(float), classes=np.array([0., 1.]))
+            num_rows += len(chunk)
+
+        print("Epoch {}: {} rows in {:.1f}s".format(epoch + 1, num_rows, time.time() - start))
+
+    return model
+
+def stream_evaluate(model, vocabulary, where='', params=None, chunksize=50000):
+    '''
+    Output: log loss and AUC of the model over the rows selected by where,
+    scored chunk by chunk. Only the labels and probabilities are kept.
+    '''
+    y_true = []
+    prob = []
+
+    for chunk in stream_chunks(stream_query(vocabulary, where), params, chunksize):
+        X, y = encode_xy(chunk, vocabulary)
+        y_true.append(y.values.astype(float))
+        prob.append(model.predict_proba(X)[:, 1])
+
+    y_true = np.concatenate(y_true)
+    prob = np.concatenate(prob)
+
+    return log_loss(y_true, prob), roc_auc_score(y_true, prob)
+
+def main(test_year=2017, chunksize=50000, epochs=1):
+    '''
+    Trains on the years before test_year, evaluates on test_year and saves
+    the model and its vocabulary next to the other models.
+    '''
+    params = {'test_year': test_year}
+
+    vocabulary = query_vocabulary(where='where year < %(test_year)s', params=params)
+    model = stream_train(vocabulary, where='where year < %(test_year)s', params=params,
+                         chunksize=chunksize, epochs=epochs)
+
+    loss, auc = stream_evaluate(model, vocabulary, 'where year = %(test_year)s', params, chunksize)
+    print("Test year {}: log loss {:.4f}, AUC {:.4f}".format(test_year, loss, auc))
+
+    with open(stream_model_path, 'wb') as f:
+        pickle.dump(model, f)
+    save_vocabulary(vocabulary, stream_vocabulary_path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Trains a model streaming cascade_full')
+    parser.add_argument('--test-year', type=int, default=2017)
+    parser.add_argument('--chunksize', type=int, default=50000)
+    parser.add_argument('--epochs', type=int, default=1)
+    args = parser.parse_args()
+
+    main(args.test_year, args.chunksize, args.epochs)
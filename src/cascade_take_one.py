@@ -7,21 +7,49 @@ import numpy as np
 import pandas as pd
 import os
 import sys
-import psycopg2
-from sqlalchemy import create_engine
+import time
+import argparse
+import joblib
+from datetime import datetime
+from multiprocessing import Pool
+from scipy import sparse as sp
 
 home_path = os.environ['CASCADE_HOME']
 sys.path.append(home_path + 'cascade/src')
 
 from cascade_sql import *
 from cascade_model import *
+from cascade_db import connection, get_engine
+from cascade_matrix_cache import load_matrices, drop_features
 
 '''
 This is a very specific module that assess the performance of a model when
 one feature is removed when holding everything else constant (sort of partial
 dependence plot but with cross validation and error metrics)
+
+Every run has a run_id. As each (feature, fold) fit finishes, its metrics
+are upserted into take_one_checkpoints, so a run that is restarted with the
+same --run-id only fits what's left. take_one_results is computed from the
+checkpoints and written once per run_id. Fitted models are only saved under
+checkpoints/<run_id>/ with --save-models, a full run fits hundreds of them.
 '''
 
+checkpoint_path = home_path + 'checkpoints/'
+
+create_checkpoints_query = '''
+        create table if not exists take_one_checkpoints (
+            run_id text,
+            removed_feature text,
+            fold text,
+            log_loss double precision,
+            accuracy double precision,
+            "AUC_score" double precision,
+            fit_seconds double precision,
+            finished_at timestamp default now(),
+            primary key (run_id, removed_feature, fold)
+        )
+        ;'''
+
 def remove_element(feature):
     '''
     Based on pre-defined list of features and features that need to be dummied
@@ -50,92 +78,359 @@ def remove_element(feature):
 
     return feat_list, dummy_list
 
-def model_fit(model, X_train, X_test, y_train, y_test, engine, feature_name, cv_folds=5):
+# Data shared with the task workers. It's set once per process by
+# init_task_worker instead of being sent along with every task.
+task_data = {}
+
+def init_task_worker(matrices, engine, params, cv_folds, run_id=None, save_models=False):
+    task_data['matrices'] = matrices
+    task_data['engine'] = engine
+    task_data['params'] = params
+    task_data['cv_folds'] = cv_folds
+    task_data['run_id'] = run_id
+    task_data['save_models'] = save_models
+
+def record_checkpoint(run_id, result):
     '''
-    This is the main engine of the process.
-    It takes in the model, data and one feature name (or lack there of) and
-    cross validation folds.
+    Upserts the fit_task() result of a task of run_id in take_one_checkpoints
+    '''
+    feature, fold, loss, accuracy, auc, fit_seconds = result
 
-    It fits the model and calles both predict and predict_proba then uses them
-    for cross validation and scores them.
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(create_checkpoints_query)
+            cursor.execute('''
+                           insert into take_one_checkpoints
+                                  (run_id, removed_feature, fold, log_loss, accuracy, "AUC_score", fit_seconds)
+                           values (%s, %s, %s, %s, %s, %s, %s)
+                           on conflict (run_id, removed_feature, fold)
+                           do update set log_loss = excluded.log_loss,
+                                         accuracy = excluded.accuracy,
+                                         "AUC_score" = excluded."AUC_score",
+                                         fit_seconds = excluded.fit_seconds,
+                                         finished_at = now()
+                           ;''', (run_id, feature, str(fold),
+                                  None if np.isnan(loss) else float(loss),
+                                  None if np.isnan(accuracy) else float(accuracy),
+                                  float(auc), float(fit_seconds)))
 
-    Once all the metrics are determined then writes them to the database.
+def load_checkpoints(run_id):
+    '''
+    Output: fit_task() results already recorded for run_id
     '''
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(create_checkpoints_query)
+            cursor.execute('''
+                           select removed_feature, fold, log_loss, accuracy, "AUC_score", fit_seconds
+                             from take_one_checkpoints
+                            where run_id = %s
+                           ;''', (run_id,))
+            rows = cursor.fetchall()
+
+    return [(feature, fold if fold == 'holdout' else int(fold),
+             np.nan if loss is None else loss,
+             np.nan if accuracy is None else accuracy,
+             auc, fit_seconds)
+            for feature, fold, loss, accuracy, auc, fit_seconds in rows]
+
+def model_checkpoint(run_id, name):
+    '''
+    Output: path of a fitted model checkpoint of run_id
+    '''
+    return checkpoint_path + '{}/{}.joblib'.format(run_id, name)
+
+def make_tasks(feat_list, cv_folds=5):
+    '''
+    Output: list of (feature, fold) tasks, the 'holdout' fit of every feature
+    on the whole train set plus one task per cross validation fold. Holdout
+    tasks are the largest fits so they are listed first.
+    '''
+    return ([(feature, 'holdout') for feature in feat_list] +
+            [(feature, fold) for feature in feat_list for fold in range(cv_folds)])
+
+def fit_task(task):
+    '''
+    Fits one (feature, fold) task on the matrices set by init_task_worker()
+    with the feature removed.
+
+    holdout: fits the train set and scores the test set
+    fold i: fits and scores fold i of StratifiedKFold over the train set,
+    the same folds cross_val_score(cv=cv_folds) used
 
+    Output: (feature, fold, log_loss, accuracy, AUC_score, fit_seconds),
+    log_loss and accuracy are only computed for holdout
+    '''
+    feature, fold = task
+    X_train, X_test, y_train, y_test = drop_features(task_data['matrices'], [feature])
+
+    if fold != 'holdout':
+        folds = StratifiedKFold(n_splits=task_data['cv_folds']).split(np.zeros(len(y_train)), y_train)
+        train_index, test_index = list(folds)[fold]
+        X_train, X_test = X_train[train_index], X_train[test_index]
+        y_train, y_test = y_train[train_index], y_train[test_index]
+
+    model = make_model(task_data['engine'], **task_data['params'])
+
+    start = time.time()
     model.fit(X_train, y_train)
+    fit_seconds = time.time() - start
+
+    prob = model.predict_proba(X_test)[:,1]
+    auc = roc_auc_score(y_test, prob)
+
+    if fold == 'holdout':
+        result = (feature, fold, log_loss(y_test, prob), accuracy_score(y_test, model.predict(X_test)),
+                  auc, fit_seconds)
+    else:
+        result = (feature, fold, np.nan, np.nan, auc, fit_seconds)
+
+    #the model is saved before the metrics so that a recorded task always
+    #has its model
+    run_id = task_data['run_id']
+    if run_id is not None:
+        if task_data['save_models']:
+            joblib.dump(model, model_checkpoint(run_id, '{}_{}'.format(feature, fold)))
+        record_checkpoint(run_id, result)
+
+    return result
+
+def run_tasks(matrices, tasks, engine='gbc', params=None, cv_folds=5, workers=None, run_id=None,
+              save_models=False):
+    '''
+    Inputs
+    matrices: as returned by cascade_matrix_cache.load_matrices()
+    tasks: as returned by make_tasks()
+    engine, params: model to fit, see cascade_model.make_model()
+    cv_folds: number of cross validation folds
+    workers: number of processes fitting tasks, defaults to the number of cpus
+    run_id: checkpoint the metrics of every finished task under run_id and
+    skip the tasks already checkpointed by a previous attempt of the same run
+    save_models: also save the fitted model of every task of run_id, see
+    model_checkpoint()
+
+    Output: list of fit_task() results, checkpointed ones first then in the
+    order tasks finish
+    '''
+    if params is None:
+        params = {}
+
+    results = []
+    if run_id is not None:
+        planned = set(tasks)
+        results = [r for r in load_checkpoints(run_id) if (r[0], r[1]) in planned]
+        done = set((r[0], r[1]) for r in results)
+        tasks = [task for task in tasks if task not in done]
+        print("Run {}: {} tasks checkpointed, {} to go".format(run_id, len(done), len(tasks)))
+
+        if save_models and not os.path.exists(checkpoint_path + run_id):
+            os.makedirs(checkpoint_path + run_id)
+
+    if workers == 1:
+        init_task_worker(matrices, engine, params, cv_folds, run_id, save_models)
+        for task in tasks:
+            results.append(fit_task(task))
+            print("Done {} {}: AUC {:.4f}".format(*results[-1][:2], results[-1][4]))
+        return results
+
+    with Pool(workers, initializer=init_task_worker,
+              initargs=(matrices, engine, params, cv_folds, run_id, save_models)) as pool:
+        for result in pool.imap_unordered(fit_task, tasks, chunksize=1):
+            results.append(result)
+            print("Done {} {}: AUC {:.4f} ({}/{})".format(result[0], result[1], result[4],
+                                                          len(results), len(tasks)))
+
+    return results
+
+def aggregate_results(results):
+    '''
+    Input: fit_task() results
+    Output: dataframe in the take_one_results shape, one row per feature with
+    the holdout metrics and the mean, std, min and max AUC of the folds
+    '''
+    tasks = pd.DataFrame.from_records(results, columns=['removed_feature', 'fold', 'log_loss', 'accuracy',
+                                                        'AUC_score', 'fit_seconds'])
+    holdout = tasks[tasks.fold == 'holdout'].set_index('removed_feature')
+    cv = tasks[tasks.fold != 'holdout'].groupby('removed_feature').AUC_score
+
+    df = pd.DataFrame({'log_loss': holdout.log_loss,
+                       'accuracy': holdout.accuracy,
+                       'AUC_score': holdout.AUC_score,
+                       'cv_mean': cv.mean(),
+                       'cv_std': cv.std(ddof=0),
+                       'cv_min': cv.min(),
+                       'cv_max': cv.max()})
+    df.index.name = 'removed_feature'
+
+    return df.reset_index()
+
+def permute_block(X, columns, order):
+    '''
+    Inputs
+    X: CSR matrix
+    columns: column indices of one feature block
+    order: row permutation
+
+    Output: copy of X where the rows of the block columns are permuted by
+    order and every other column is left as is
+    '''
+    in_block = np.zeros(X.shape[1], dtype=bool)
+    in_block[columns] = True
+
+    X = X.tocsr()
+    rest = X.multiply(sp.csr_matrix((~in_block).astype(float)))
+    block = X.multiply(sp.csr_matrix(in_block.astype(float))).tocsr()
+
+    return (rest + block[order]).tocsr()
+
+def permutation_results(matrices, feat_list, engine='gbc', params=None, repeats=5, seed=127, run_id=None):
+    '''
+    Permutation importance alternative to the take one runs: the model is
+    fitted once on the train set with every feature and the test set is
+    scored with the column block of each feature (e.g. all the
+    property_code_* columns) permuted across rows.
+
+    Inputs
+    matrices: as returned by cascade_matrix_cache.load_matrices()
+    feat_list: features to permute
+    engine, params: model to fit, see cascade_model.make_model()
+    repeats: permutations per feature. All of a feature's permuted copies
+    are scored with one predict_proba call.
+    seed: random seed of the permutations
+    run_id: the fitted model is checkpointed under run_id and reused when
+    the run is restarted. It's the only model of the run, so unlike
+    run_tasks() it's always saved.
+
+    Output: dataframe in the take_one_results shape, one row per feature
+    with the mean log_loss, accuracy and AUC over the repeats and the mean,
+    std, min and max AUC of the repeats in the cv_* columns
+    '''
+    if params is None:
+        params = {}
+
+    rng = np.random.RandomState(seed)
+    X_train, X_test = matrices['X_train'], matrices['X_test']
+    y_train, y_test = np.asarray(matrices['y_train']), np.asarray(matrices['y_test'])
+    num_rows = X_test.shape[0]
+
+    if run_id is not None and os.path.exists(model_checkpoint(run_id, 'permutation')):
+        model = joblib.load(model_checkpoint(run_id, 'permutation'))
+        print("Run {}: loaded the fitted model".format(run_id))
+    else:
+        model = make_model(engine, **params)
+        start = time.time()
+        model.fit(X_train, y_train)
+        print("Fitted in {:.0f}s".format(time.time() - start))
+
+        if run_id is not None:
+            if not os.path.exists(checkpoint_path + run_id):
+                os.makedirs(checkpoint_path + run_id)
+            joblib.dump(model, model_checkpoint(run_id, 'permutation'))
 
-    #Predict training set:
-    predictions = model.predict(X_test)
     prob = model.predict_proba(X_test)[:,1]
+    print("All features: AUC {:.4f}".format(roc_auc_score(y_test, prob)))
+
+    result = []
+    for feature in feat_list:
+        columns = matrices['blocks'][feature]
+        X_permuted = sp.vstack([permute_block(X_test, columns, rng.permutation(num_rows))
+                                for i in range(repeats)]).tocsr()
+        prob = model.predict_proba(X_permuted)[:,1].reshape(repeats, num_rows)
+
+        losses = [log_loss(y_test, p, labels=[0, 1]) for p in prob]
+        accuracies = np.mean((prob > .5) == (y_test == 1), axis=1)
+        aucs = np.array([roc_auc_score(y_test, p) for p in prob])
+
+        print("Permuted {}: AUC {:.4f}".format(feature, aucs.mean()))
+        result.append((feature, np.mean(losses), accuracies.mean(), aucs.mean(),
+                       aucs.mean(), aucs.std(), aucs.min(), aucs.max()))
 
-    #Perform cross-validation:
-    cv_score = cross_val_score(model, X_train, y_train, cv=cv_folds, scoring='roc_auc')
+    labels = ['removed_feature', 'log_loss', 'accuracy', 'AUC_score', 'cv_mean', 'cv_std', 'cv_min', 'cv_max']
+    return pd.DataFrame.from_records(result, columns=labels)
 
-    result = [(feature_name,
-               log_loss(y_test, prob),
-               accuracy_score(y_test, predictions),
-               roc_auc_score(y_test, prob),
-               np.mean(cv_score),
-               np.std(cv_score),
-               np.min(cv_score),
-               np.max(cv_score))]
-    labels = ['removed_feature', 'log_loss','accuracy', 'AUC_score', 'cv_mean', 'cv_std', 'cv_min', 'cv_max']
-    df = pd.DataFrame.from_records(result, columns=labels)
-    df = df.append([df],ignore_index=True)
+def write_results(df, run_id):
+    '''
+    Appends the results of run_id to take_one_results with a run_id column,
+    unless they were already written by a previous attempt of the run. The
+    rows are copied by column name, so tables created before the run_id
+    column was added are fine.
+    '''
+    df = df.copy()
+    df['run_id'] = run_id
+    #creates the table when it doesn't exist yet
+    df.head(0).to_sql('take_one_results', get_engine(), if_exists='append', index=False)
 
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('alter table take_one_results add column if not exists run_id text')
+            cursor.execute('select count(*) from take_one_results where run_id = %s', (run_id,))
+            if cursor.fetchone()[0] > 0:
+                print("Run {}: results already written".format(run_id))
+                return
 
-    write_to_table(df, engine, 'take_one_results', 'append')
+            copy_frame(cursor, df, 'take_one_results')
 
-def main():
+def main(workers=None, cv_folds=5, mode='take_one', repeats=5, run_id=None, save_models=False):
     '''
     This is the main funciton that drives the process.
     It retrieves data from CASCAD_FULL table.
-    Instantiates a model: in this case GBC, hardcoded
-    And loops through list of pre definied features and calls
-    model_fit function.
-    '''
+    Fits a model (GBC with the production settings, see
+    cascade_model.make_model) without each of the pre defined features,
+    spreading the feature x fold fits over workers processes, and writes
+    one row per feature to take_one_results at the end.
 
-    dbname = os.environ['CASCADE_DB_DBNAME']
-    host = os.environ['CASCADE_DB_HOST']
-    username = os.environ['CASCADE_DB_USERNAME']
-    password = os.environ['CASCADE_DB_PASSWORD']
-    port = 5432
+    With mode 'permutation' the model is fitted once and each feature is
+    permuted instead, see permutation_results().
 
-    conn = psycopg2.connect(dbname=dbname,
-                            user=username, password=password,
-                            host=host,
-                            port=port)
+    run_id: id of the run to resume, a new run is started when None
+    save_models: keep the fitted model of every task, see run_tasks()
+    '''
+    if run_id is None:
+        run_id = '{}_{}'.format(mode, datetime.now().strftime('%Y%m%d_%H%M%S'))
+    print("Run {}, restart with --run-id {} to resume it".format(run_id, run_id))
 
     query = '''
             select * from cascade_full
             ;'''
 
-    cascade = pd.read_sql_query(query, conn)
-    conn.close()
+    with connection() as conn:
+        cascade = pd.read_sql_query(query, conn)
     X = cascade.copy()
 
     feat_list = ['property_code', 'property_city', 'property_zip', 'series', 'num_guests',
                  'num_bedrooms', 'num_bathrooms', 'allows_pets', 'property_rating',
                  'manager_rating', 'weekend', 'season', 'min_nights']
 
-    GBC = GradientBoostingClassifier(learning_rate=.05,
-                                     n_estimators=1000,
-                                     max_depth=10,
-                                     subsample=1,
-                                     max_features='sqrt',
-                                     random_state=1)
+    # Encoded once with every feature, each task drops the column block
+    # of its feature instead of re-encoding (see cascade_matrix_cache)
+    prop, dummy = remove_element(None)
+    matrices = load_matrices(X, prop, dummy)
 
-    lr = LogisticRegression()
+    if mode == 'permutation':
+        df = permutation_results(matrices, feat_list, 'gbc', repeats=repeats, run_id=run_id)
+    else:
+        start = time.time()
+        results = run_tasks(matrices, make_tasks(feat_list, cv_folds), 'gbc', cv_folds=cv_folds,
+                            workers=workers, run_id=run_id, save_models=save_models)
+        print("{} fits in {:.0f}s".format(len(results), time.time() - start))
 
-    for feature in feat_list:
-        address = 'postgresql://{}:{}@{}:{}/{}'.format(username, password, host, port, dbname)
-        engine = create_engine(address)
-
-        prop, dummy = remove_element(feature)
+        df = aggregate_results(results)
+        df = df.set_index('removed_feature').loc[feat_list].reset_index()
 
-        X_train, X_test, y_train, y_test, unique_prop_codes = prepare_xy(X, prop, dummy)
-
-        model_fit(GBC, X_train, X_test, y_train, y_test, engine, feature)
+    write_results(df, run_id)
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Leave one feature out experiment')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes fitting models, defaults to the number of cpus')
+    parser.add_argument('--cv-folds', type=int, default=5)
+    parser.add_argument('--mode', choices=['take_one', 'permutation'], default='take_one',
+                        help='retrain without each feature or permute it in a single fitted model')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='permutations per feature in permutation mode')
+    parser.add_argument('--run-id', help='resume the run with this id')
+    parser.add_argument('--save-models', action='store_true',
+                        help='save the fitted model of every feature and fold under checkpoints/')
+    args = parser.parse_args()
+
+    main(args.workers, args.cv_folds, args.mode, args.repeats, args.run_id, args.save_models)
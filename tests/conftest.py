@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# Modules read CASCADE_HOME at import time, tests use a scratch one
+os.environ.setdefault('CASCADE_HOME', tempfile.mkdtemp() + '/')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
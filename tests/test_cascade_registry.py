@@ -0,0 +1,43 @@
+import os
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+
+import cascade_registry
+
+def fitted_model():
+    return LogisticRegression().fit(np.array([[0.], [1.], [2.], [3.]]), np.array([0, 0, 1, 1]))
+
+def test_register_model_numbers_versions(tmp_path, monkeypatch):
+    monkeypatch.setattr(cascade_registry, 'registry_path', str(tmp_path) + '/')
+
+    assert cascade_registry.register_model(fitted_model(), 'test') == '0001'
+    assert cascade_registry.register_model(fitted_model(), 'test') == '0002'
+    assert cascade_registry.list_versions('test') == ['0001', '0002']
+
+def test_register_model_retries_when_version_is_taken(tmp_path, monkeypatch):
+    monkeypatch.setattr(cascade_registry, 'registry_path', str(tmp_path) + '/')
+    rename = os.rename
+    taken = []
+
+    def racing_rename(source, target):
+        #another process registers the same version number just before us
+        if not taken:
+            os.makedirs(target + '/other')
+            taken.append(os.path.basename(target))
+        rename(source, target)
+
+    monkeypatch.setattr(os, 'rename', racing_rename)
+    version = cascade_registry.register_model(fitted_model(), 'test', snapshot='abc',
+                                              metrics={'AUC_score': .8}, engine='logistic')
+
+    assert taken == ['0001']
+    assert version == '0002'
+    assert os.path.exists(str(tmp_path) + '/test/0001/other')
+
+    metadata = cascade_registry.load_metadata('test', version)
+    assert metadata['version'] == '0002'
+    assert metadata['name'] == 'test'
+    assert metadata['snapshot'] == 'abc'
+    assert metadata['metrics'] == {'AUC_score': .8}
+    assert metadata['engine'] == 'logistic'
+    assert not [path for path in os.listdir(str(tmp_path) + '/test') if '.tmp' in path]
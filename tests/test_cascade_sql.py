@@ -0,0 +1,70 @@
+import struct
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('sqlalchemy')
+from cascade_sql import binary_chunks, copy_binary_header, fixed_width_values
+
+def decode_binary_copy(data):
+    '''
+    Output: list of rows of the binary COPY data, every field as bytes or
+    None for NULL
+    '''
+    assert data[:len(copy_binary_header)] == copy_binary_header
+    position = len(copy_binary_header)
+
+    rows = []
+    while True:
+        num_fields, = struct.unpack('>h', data[position:position + 2])
+        position += 2
+        if num_fields == -1:
+            break
+
+        row = []
+        for i in range(num_fields):
+            length, = struct.unpack('>i', data[position:position + 4])
+            position += 4
+            if length == -1:
+                row.append(None)
+            else:
+                row.append(data[position:position + length])
+                position += length
+        rows.append(row)
+
+    assert position == len(data)
+    return rows
+
+# Integer column types pandas to_sql creates: smallint, integer or bigint
+@pytest.mark.parametrize('dtype, width', [('int8', 2), ('uint8', 2), ('int16', 2),
+                                          ('uint16', 4), ('int32', 4),
+                                          ('uint32', 8), ('int64', 8)])
+def test_integer_round_trip(dtype, width):
+    info = np.iinfo(dtype)
+    values = np.array([info.min, 0, 1, info.max], dtype=dtype)
+    df = pd.DataFrame({'value': values})
+
+    rows = decode_binary_copy(b''.join(binary_chunks(df, 3)))
+
+    assert [len(row[0]) for row in rows] == [width] * len(values)
+    decoded = [int.from_bytes(row[0], 'big', signed=True) for row in rows]
+    assert decoded == [int(v) for v in values]
+
+def test_uint64_is_rejected():
+    with pytest.raises(ValueError):
+        fixed_width_values(pd.Series(np.array([1], dtype='uint64'), name='value'))
+
+def test_mixed_round_trip_with_nulls():
+    df = pd.DataFrame({'code': ['a', None, 'b'],
+                       'month_no': np.array([1, 2, 12], dtype=np.int16),
+                       'rate': [1.5, np.nan, 3.0],
+                       'day': pd.to_datetime(['2000-01-02', None, '2017-06-30'])})
+
+    rows = decode_binary_copy(b''.join(binary_chunks(df, 2)))
+
+    assert [row[0] for row in rows] == [b'a', None, b'b']
+    assert [struct.unpack('>h', row[1])[0] for row in rows] == [1, 2, 12]
+    assert [None if row[2] is None else struct.unpack('>d', row[2])[0] for row in rows] == [1.5, None, 3.0]
+    #microseconds since 2000-01-01
+    assert rows[0][3] == struct.pack('>q', 86400 * 10**6)
+    assert rows[1][3] is None